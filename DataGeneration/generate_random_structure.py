@@ -4,9 +4,14 @@ import random
 import os
 import shutil
 import random
+import json
+import sys
 from copy import deepcopy
 from structure import *
 import sections_tw, sections_usa
+sys.path.append("../")
+from Utils.ground_motion import ground_motion_record_id, ground_motion_record_path
+from Utils.dataset import GROUND_MOTION_ROOT
 
 
 # A table which correspond face to node feature's yielding moment face index
@@ -377,7 +382,10 @@ def _generate_ipt(modal_file_path,
 
 
 def generate_random_structure(target_dir, structure_num, start_index=1, ground_motion_type='World',
-                              ground_motion_level='mixed', maximum_duration=100, section_country="USA", prioritized=None):
+                              ground_motion_level='mixed', maximum_duration=100, section_country="USA", prioritized=None,
+                              copy_ground_motion=False, dataset_ground_motion_root=GROUND_MOTION_ROOT):
+    # dataset_ground_motion_root: folder the dataset (train.py --ground_motion_root) reads the referenced records from,
+    # it must hold the same level folders as the ground motion source below (e.g. GroundMotions_World_processed_BSE-1)
     print("Start generating structure......")
     
     if section_country == "USA":
@@ -415,8 +423,22 @@ def generate_random_structure(target_dir, structure_num, start_index=1, ground_m
         ground_motion_file_1 = os.path.join(ground_motion_root, ground_motion_folder, ground_motion_name + "_FN.txt")
         ground_motion_file_2 = os.path.join(ground_motion_root, ground_motion_folder, ground_motion_name + "_FP.txt")
 
-        shutil.copyfile(ground_motion_file_1, os.path.join(folder_name, "ground_motion_1.txt"))
-        shutil.copyfile(ground_motion_file_2, os.path.join(folder_name, "ground_motion_2.txt"))
+        # Reference the records by id instead of copying them into every structure folder,
+        # the dataset reads them from its ground motion root and keeps one copy of each pair in its bank.
+        ground_motion_reference = {"record_id_1": ground_motion_record_id(ground_motion_file_1),
+                                   "record_id_2": ground_motion_record_id(ground_motion_file_2)}
+        with open(os.path.join(folder_name, "ground_motion.json"), "w") as f:
+            json.dump(ground_motion_reference, f)
+        if copy_ground_motion:
+            shutil.copyfile(ground_motion_file_1, os.path.join(folder_name, "ground_motion_1.txt"))
+            shutil.copyfile(ground_motion_file_2, os.path.join(folder_name, "ground_motion_2.txt"))
+        else:
+            # the folder can only be loaded if the dataset finds the referenced records
+            for record_id in [ground_motion_reference["record_id_1"], ground_motion_reference["record_id_2"]]:
+                record_path = ground_motion_record_path(record_id, dataset_ground_motion_root)
+                if os.path.exists(record_path) == False:
+                    print(f"       Warning: {record_path} doesn't exist, copy {ground_motion_root} into {dataset_ground_motion_root} "
+                          f"or load the dataset with --ground_motion_root {os.path.dirname(ground_motion_root)}")
         print("      ", ground_motion_file_1)
         print("      ", ground_motion_file_2)
 
@@ -523,7 +523,7 @@ def check_if_pt_file_already_exist(target_dir, structure_dir):
 
 
 
-final_extension_list = ['ipt', 'pt', 'txt']
+final_extension_list = ['ipt', 'pt', 'txt', 'json']
 def delete_useless_files_after_graph(target_dir):
     for structure_dir in os.listdir(target_dir):
         structure_dir = os.path.join(target_dir, structure_dir)
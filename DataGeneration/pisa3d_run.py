@@ -120,7 +120,7 @@ def run_pisa_all(analysis="structure"):
 
 
 
-keeped_extensions = ['ipt', 'Eigen', 'Modal', 'ElemRecord', 'NodeDisRecord', 'NodeAccRecord', 'NodeVelRecord', 'pt', 'txt']
+keeped_extensions = ['ipt', 'Eigen', 'Modal', 'ElemRecord', 'NodeDisRecord', 'NodeAccRecord', 'NodeVelRecord', 'pt', 'txt', 'json']
 def delete_useless_files_in_dir(case_dir):
     print("Start deleting useless files......")
     for analysis_file in os.listdir(case_dir):
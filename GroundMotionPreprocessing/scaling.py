@@ -4,6 +4,9 @@ import os
 from os.path import join
 from tqdm import tqdm
 import eqsig.single
+import sys
+sys.path.append("../")
+from Utils.ground_motion import read_ground_motion
 
 
 source = "World"
@@ -93,10 +96,10 @@ for i, gm_file in enumerate(os.listdir(source_gm_folder)):
     appeared_gm.append(gm_name)
 
     # find the scale factor
-    file_FN = np.loadtxt(source_gm_FN_path)
-    file_FP = np.loadtxt(source_gm_FP_path)
-    gm_FN = file_FN[:, 1] / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
-    gm_FP = file_FP[:, 1] / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
+    time_FN, acc_FN = read_ground_motion(source_gm_FN_path, return_time=True)
+    time_FP, acc_FP = read_ground_motion(source_gm_FP_path, return_time=True)
+    gm_FN = acc_FN / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
+    gm_FP = acc_FP / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
     record_FN = eqsig.AccSignal(gm_FN, dt)
     record_FP = eqsig.AccSignal(gm_FP, dt)
     record_FN.generate_response_spectrum(response_times=periods)
@@ -130,22 +133,8 @@ for i, gm_file in enumerate(os.listdir(source_gm_folder)):
     # Rewrite the ground motion file with scale_factor
     target_gm_FN_path = join(target_gm_path, gm_FN_name)
     target_gm_FP_path = join(target_gm_path, gm_FP_name)
-    new_content_FN = ""
-    new_content_FP = ""
-
-    with open(source_gm_FN_path, "r") as f:
-        for i, line in enumerate(f.readlines()):
-            contents = line.strip().split()
-            new_content_FN += f"{float(contents[0]) :.4f}\t{float(contents[1]) * scale_factor :.3f}\n"
-    with open(source_gm_FP_path, "r") as f:
-        for i, line in enumerate(f.readlines()):
-            contents = line.strip().split()
-            new_content_FP += f"{float(contents[0]) :.4f}\t{float(contents[1]) * scale_factor :.3f}\n"
-
-    with open(target_gm_FN_path, "w") as f:
-        f.write(new_content_FN)
-    with open(target_gm_FP_path, "w") as f:
-        f.write(new_content_FP)
+    np.savetxt(target_gm_FN_path, np.stack([time_FN, acc_FN * scale_factor], axis=1), fmt=["%.4f", "%.3f"], delimiter="\t")
+    np.savetxt(target_gm_FP_path, np.stack([time_FP, acc_FP * scale_factor], axis=1), fmt=["%.4f", "%.3f"], delimiter="\t")
 
 
 
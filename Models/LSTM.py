@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import torch_geometric as tg
 from torch_geometric.nn import global_mean_pool
 from .layers import *
@@ -48,19 +50,90 @@ class GraphTimeSeriesEncoder(nn.Module):
             input_dim, graph_lstm_hidden_dim, graph_lstm_num_layers, batch_first=True
         )
 
-    def forward(self, latent, ground_motions):
+    def forward(self, latent, ground_motions, state=None, return_state=False):
         # latent: [batch_size, latent_dim]
         # ground_motions: [batch_size, timesteps(2000), ground_motion_dim(20)]
         # first expand latent to [batch_size, timesteps(2000), latent_dim],
         # then concat latent with ground_motions [batch_size, timesteps(2000), latent_dim + gm_per_timestep]
+        # state: (h, c) of the LSTM after the previous timesteps (None: start of the sequence)
 
         timesteps = ground_motions.shape[1]
         latent = latent.unsqueeze(1).expand(-1, timesteps, -1)
         graph_ground_motion_input = torch.cat([latent, ground_motions], dim=2)
-        graph_time_series_behavior, (_, _) = self.lstm(graph_ground_motion_input)
+        graph_time_series_behavior, state = self.lstm(graph_ground_motion_input, state)
+        if return_state:
+            return graph_time_series_behavior, state
         return graph_time_series_behavior
 
 
+def lstm_cell_(gates, H, C):
+    # in place LSTMCell update from the pre-activation gates [node_num, 4 * hidden] (i, f, g, o):
+    # C = f * C + i * g, H = o * tanh(C), the gates buffer is overwritten
+    input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+    input_gate.sigmoid_()
+    forget_gate.sigmoid_()
+    cell_gate.tanh_()
+    output_gate.sigmoid_()
+    C.mul_(forget_gate).addcmul_(input_gate, cell_gate)
+    torch.tanh(C, out=H)
+    H.mul_(output_gate)
+
+
+class DecoderState(object):
+    # Hidden / cell states of the node LSTM layers, H[i], C[i]: [node_num, node_lstm_hidden_dim].
+    # In torch.no_grad() the decoder updates them in place, with its per-step buffers in workspace.
+    def __init__(self, H, C, workspace=None):
+        self.H = H
+        self.C = C
+        self.workspace = workspace
+
+    def detach(self):
+        return DecoderState([H.detach() for H in self.H], [C.detach() for C in self.C])
+
+
+class DecoderWorkspace(object):
+    # Everything the in-place decoder step needs, allocated once per sequence:
+    # the input gates of every timestep precomputed per graph, the split / transposed weights,
+    # and the buffers of one step. Weights and buffers take the dtype of node_input
+    # (bfloat16 under CPU autocast, the in-place ops are not autocast themselves).
+    def __init__(self, decoder, node_input, graph_input, ground_motions, row_num=None, output_index=None):
+        # node_input: [node_num, node_lstm_hidden_dim], graph_input: [timesteps, batch_size, node_lstm_hidden_dim]
+        # ground_motions: [batch_size, timesteps, ground_motion_dim]
+        # row_num: rows of the states (node_num, or batch_size * node_num for forward_ground_motions)
+        # output_index: the output channels to compute (all if None), the output layer is cut to their rows
+        gm_dim = decoder.ground_motion_dim
+        dtype = node_input.dtype
+        gms = ground_motions.permute(1, 0, 2)
+        self.input_gates, self.weight_ih, self.weight_hh = [], [], []
+        for i, cell in enumerate(decoder.lstmCellList):
+            bias = cell.bias_ih + cell.bias_hh
+            if i == 0:
+                # gates of layer 0 = node part (static) + graph part (per graph and timestep)
+                self.node_gates = F.linear(node_input, cell.weight_ih, bias)
+                self.input_gates.append(F.linear(graph_input, cell.weight_ih))
+                self.weight_ih.append(None)
+            else:
+                # input of layer i = [H of layer i - 1 without its last gm_dim features, gms]
+                self.input_gates.append(F.linear(gms, cell.weight_ih[:, -gm_dim:], bias))
+                self.weight_ih.append(cell.weight_ih[:, :-gm_dim].t().to(dtype))
+            self.weight_hh.append(cell.weight_hh.t().to(dtype))
+
+        hidden_layer, output_layer = decoder.response_decoder.module_list
+        hidden_dim = decoder.lstmCellList[0].hidden_size
+        self.response_weight_H = hidden_layer.weight[:, :hidden_dim].t().to(dtype)
+        self.response_weight_C = hidden_layer.weight[:, hidden_dim:].t().to(dtype)
+        self.response_bias = hidden_layer.bias.to(dtype)
+        output_weight, output_bias = output_layer.weight, output_layer.bias
+        if output_index is not None:
+            output_weight, output_bias = output_weight.index_select(0, output_index), output_bias.index_select(0, output_index)
+        self.output_weight = output_weight.t().to(dtype)
+        self.output_bias = output_bias.to(dtype)
+
+        row_num = node_input.shape[0] if row_num is None else row_num
+        self.gates = node_input.new_empty((row_num, 4 * hidden_dim))
+        self.response_hidden = node_input.new_empty((row_num, hidden_layer.out_features))
+
+
 class NodeTimeSeriesDecoder(nn.Module):
     def __init__(
         self,
@@ -71,6 +144,7 @@ class NodeTimeSeriesDecoder(nn.Module):
         node_lstm_num_layers,
         output_dim,
         device,
+        checkpoint_timesteps=0,
     ):
         super(NodeTimeSeriesDecoder, self).__init__()
 
@@ -80,6 +154,9 @@ class NodeTimeSeriesDecoder(nn.Module):
         self.num_layers = node_lstm_num_layers
         self.output_dim = output_dim
         self.device = device
+        # activation checkpointing: with autograd, only the states between blocks of checkpoint_timesteps
+        # timesteps are kept, the activations of a block are recomputed in backward (0: keep all)
+        self.checkpoint_timesteps = checkpoint_timesteps
 
         self.input_dim = node_dim + graph_lstm_hidden_dim + ground_motion_dim
         self.node_encoder = MLP(
@@ -94,76 +171,364 @@ class NodeTimeSeriesDecoder(nn.Module):
             node_lstm_hidden_dim * 2, [64], output_dim, act=True, dropout=False
         )
 
-    def create_ground_motion_graph(self, gms, node, ptr, latent):
-        # gms: [batch_size, ground_motion_dim]
-        # latent: [batch_size, graph_lstm_hidden_dim]
-        bs = len(ptr) - 1
-        x = torch.zeros(node.shape[0], self.input_dim).to(self.device)
-        x[:, 0 : self.node_dim] = node
-        for b in range(bs):
-            x[
-                ptr[b] : ptr[b + 1],
-                self.node_dim : self.node_dim + self.graph_lstm_hidden_dim,
-            ] = latent[b]
-            x[ptr[b] : ptr[b + 1], -self.ground_motion_dim :] = gms[b]
-        x = self.node_encoder(x)
-        return x
-
-    def next_cell_input(self, H, gms, ptr):
+    def encode_inputs(self, node, graph_time_series_behavior, ground_motions):
+        # node_encoder is one linear layer on [node, latent, gms], so it is split into
+        # the static node part (computed once) and the graph part of every timestep (one batched matmul).
+        # node_input: [node_num, node_lstm_hidden_dim]
+        # graph_input: [timesteps, batch_size, node_lstm_hidden_dim]
+        linear = self.node_encoder.module_list[0]
+        node_input = F.linear(
+            node, linear.weight[:, : self.node_dim], linear.bias
+        )
+        graph_ground_motion_input = torch.cat(
+            [graph_time_series_behavior, ground_motions], dim=2
+        ).permute(1, 0, 2)
+        graph_input = F.linear(
+            graph_ground_motion_input, linear.weight[:, self.node_dim :]
+        )
+        return node_input, graph_input
+
+    def create_ground_motion_graph(self, node_input, graph_input, node_graph_index):
+        # graph_input: [batch_size, node_lstm_hidden_dim] of one timestep
+        # every node gets the latent and ground motion of its graph
+        return node_input + graph_input.index_select(0, node_graph_index)
+
+    def next_cell_input(self, H, gms, node_graph_index):
         # gms: [batch_size, ground_motion_dim]
-        H_gm = H.clone()
-        bs = len(ptr) - 1
-        for b in range(bs):
-            H_gm[ptr[b] : ptr[b + 1], -self.ground_motion_dim :] = gms[b]
+        # the last ground_motion_dim features of H are replaced by the ground motion of the node's graph
+        H_gm = torch.cat(
+            [
+                H[:, : -self.ground_motion_dim],
+                gms.index_select(0, node_graph_index),
+            ],
+            dim=1,
+        )
         return H_gm
 
     def create_response(self, H, C):
-        state = torch.cat([H, C], dim=1)
+        state = torch.cat([H, C], dim=-1)
         node_out = self.response_decoder(state)
         return node_out
 
-    def forward_one_timestep(self, gms, node, ptr, latent, H_list, C_list):
-        x = self.create_ground_motion_graph(gms, node, ptr, latent)
+    def init_state(self, x):
+        # every layer starts from the encoded input of the first timestep
+        H = [x.clone() for _ in range(self.num_layers)]
+        C = [x.clone() for _ in range(self.num_layers)]
+        return DecoderState(H, C)
 
+    def forward_one_timestep(self, gms, x, node_graph_index, state):
         for i in range(self.num_layers):
-            H_list[i] = x if H_list[i] is None else H_list[i]
-            C_list[i] = x if C_list[i] is None else C_list[i]
+            if i == 0:
+                cell_input = x
+            else:
+                cell_input = self.next_cell_input(state.H[i - 1], gms, node_graph_index)
+            state.H[i], state.C[i] = self.lstmCellList[i](
+                cell_input, (state.H[i], state.C[i])
+            )
 
+        y = self.create_response(state.H[-1], state.C[-1])
+        return y
+
+    def forward_one_timestep_(self, t, node_graph_index, state, out):
+        # in place version of forward_one_timestep (torch.no_grad() only): LSTMCell math on the
+        # workspace buffers, H, C updated in place and the response written into out
+        # (node_graph_index None: the rows are [graph, node] of forward_ground_motions, the gates of
+        # each graph are broadcast over the nodes shared by every graph instead of gathered per row)
+        workspace = state.workspace
+        gates = workspace.gates
         for i in range(self.num_layers):
-            if i == 0:
-                H_list[i], C_list[i] = self.lstmCellList[i](x, (H_list[i], C_list[i]))
+            if node_graph_index is None:
+                graph_gates = workspace.input_gates[i][t].unsqueeze(1)
+                graph_node_gates = gates.view(graph_gates.shape[0], -1, gates.shape[1])
+                if i == 0:
+                    torch.add(graph_gates, workspace.node_gates, out=graph_node_gates)
+                else:
+                    graph_node_gates.copy_(graph_gates)
             else:
-                H_list[i], C_list[i] = self.lstmCellList[i](
-                    self.next_cell_input(H_list[i - 1], gms, ptr),
-                    (H_list[i], C_list[i]),
-                )
+                torch.index_select(workspace.input_gates[i][t], 0, node_graph_index, out=gates)
+                if i == 0:
+                    gates.add_(workspace.node_gates)
+            if i > 0:
+                gates.addmm_(state.H[i - 1][:, : -self.ground_motion_dim], workspace.weight_ih[i])
+            gates.addmm_(state.H[i], workspace.weight_hh[i])
+            lstm_cell_(gates, state.H[i], state.C[i])
+
+        # response_decoder on [H, C] without concatenating them
+        hidden = workspace.response_hidden
+        torch.addmm(workspace.response_bias, state.H[-1], workspace.response_weight_H, out=hidden)
+        hidden.addmm_(state.C[-1], workspace.response_weight_C).relu_()
+        torch.addmm(workspace.output_bias, hidden, workspace.output_weight, out=out)
+        return out
+
+    def forward(
+        self,
+        node,
+        node_graph_index,
+        graph_time_series_behavior,
+        ground_motions,
+        state=None,
+        return_state=False,
+        output_index=None,
+    ):
+        # node: [node_num, node_dim], node_graph_index: [node_num] graph (in the batch) of each node
+        # state: DecoderState after the previous timesteps (None: start of the sequence)
+        # output_index: only these output channels are returned (all if None)
+        if not torch.is_grad_enabled():
+            return self.forward_inplace(
+                node,
+                node_graph_index,
+                graph_time_series_behavior,
+                ground_motions,
+                state,
+                return_state,
+                output_index,
+            )
+        return self.forward_sequence(
+            node,
+            node_graph_index,
+            graph_time_series_behavior,
+            ground_motions,
+            state,
+            return_state,
+            output_index,
+        )
+
+    def forward_sequence(
+        self,
+        node,
+        node_graph_index,
+        graph_time_series_behavior,
+        ground_motions,
+        state=None,
+        return_state=False,
+        output_index=None,
+    ):
+        node_input, graph_input = self.encode_inputs(
+            node, graph_time_series_behavior, ground_motions
+        )
+        if state is None:
+            state = self.init_state(
+                self.create_ground_motion_graph(node_input, graph_input[0], node_graph_index)
+            )
 
-        y = self.create_response(H_list[-1], C_list[-1])
-        return H_list, C_list, y
+        block = self.checkpoint_timesteps
+        timesteps = graph_input.shape[0]
+        if block <= 0 or block >= timesteps or not torch.is_grad_enabled():
+            output, state = self.decode(
+                node_input, graph_input, ground_motions, node_graph_index, state
+            )
+        else:
+            outputs = []
+            for start in range(0, timesteps, block):
+                output, *H_C = checkpoint(
+                    self.decode_block,
+                    node_input,
+                    graph_input[start : start + block],
+                    ground_motions[:, start : start + block],
+                    node_graph_index,
+                    *state.H,
+                    *state.C,
+                    use_reentrant=False,
+                )
+                state = DecoderState(H_C[: self.num_layers], H_C[self.num_layers :])
+                outputs.append(output)
+            output = torch.cat(outputs, dim=1)
+
+        if output_index is not None:
+            output = output.index_select(-1, output_index)
+        if return_state:
+            return output, state
+        return output
 
-    def forward(self, node, ptr, graph_time_series_behavior, ground_motions):
-        # preparation
-        timesteps = graph_time_series_behavior.shape[1]
-        output = torch.zeros((node.shape[0], timesteps, self.output_dim)).to(
+    def decode(self, node_input, graph_input, ground_motions, node_graph_index, state):
+        # the timesteps of graph_input (and ground_motions) from state,
+        # returns output: [node_num, timesteps, output_dim] and the state after the last timestep
+        timesteps = graph_input.shape[0]
+        output = torch.zeros((node_input.shape[0], timesteps, self.output_dim)).to(
             self.device
         )
-        H_list = [None for _ in range(self.num_layers)]
-        C_list = [None for _ in range(self.num_layers)]
+        state = DecoderState(list(state.H), list(state.C))
 
         # loop for each time step (make ground_motions: [timesteps(2000), batch_size, gm_per_timestep])
-        for i, (gms, latent) in enumerate(
-            zip(
-                ground_motions.permute(1, 0, 2),
-                graph_time_series_behavior.permute(1, 0, 2),
-            )
+        for i, (gms, graph_input_t) in enumerate(
+            zip(ground_motions.permute(1, 0, 2), graph_input)
         ):
-            H_list, C_list, out = self.forward_one_timestep(
-                gms, node, ptr, latent, H_list, C_list
+            x = self.create_ground_motion_graph(node_input, graph_input_t, node_graph_index)
+            output[:, i, :] = self.forward_one_timestep(gms, x, node_graph_index, state)
+        return output, state
+
+    def decode_block(self, node_input, graph_input, ground_motions, node_graph_index, *H_C):
+        # decode with the states as tensor arguments and outputs (for checkpoint)
+        state = DecoderState(list(H_C[: self.num_layers]), list(H_C[self.num_layers :]))
+        output, state = self.decode(
+            node_input, graph_input, ground_motions, node_graph_index, state
+        )
+        return (output, *state.H, *state.C)
+
+    def forward_inplace(
+        self,
+        node,
+        node_graph_index,
+        graph_time_series_behavior,
+        ground_motions,
+        state=None,
+        return_state=False,
+        output_index=None,
+    ):
+        # inference: after the workspace is set up, the timesteps allocate no new tensors
+        # (output is [timesteps, node_num, output_dim], so the response of each step is contiguous)
+        # a given state is updated in place, with output_index only those channels are projected
+        node_input, graph_input = self.encode_inputs(
+            node, graph_time_series_behavior, ground_motions
+        )
+        timesteps = graph_input.shape[0]
+        output_dim = self.output_dim if output_index is None else output_index.shape[0]
+        output = node_input.new_empty((timesteps, node.shape[0], output_dim))
+
+        if state is None:
+            state = self.init_state(
+                self.create_ground_motion_graph(node_input, graph_input[0], node_graph_index)
             )
-            output[:, i, :] = out
+        state.workspace = DecoderWorkspace(self, node_input, graph_input, ground_motions, output_index=output_index)
+        for t in range(timesteps):
+            self.forward_one_timestep_(t, node_graph_index, state, output[t])
+        state.workspace = None
+        if return_state:
+            return output.permute(1, 0, 2), state
+        return output.permute(1, 0, 2)
+
+    def forward_ground_motions(
+        self,
+        node,
+        graph_time_series_behavior,
+        ground_motions,
+        state=None,
+        return_state=False,
+        output_index=None,
+    ):
+        # one structure under a batch of ground motions (inference, torch.no_grad()): node: [node_num, node_dim]
+        # is shared by every ground motion, so node_input and the static gates are computed for node_num rows only.
+        # The states are [gm_num * node_num, node_lstm_hidden_dim] (ground motion major), one GEMM per layer and
+        # timestep for the whole batch; output: [gm_num, node_num, timesteps, output_dim]
+        node_input, graph_input = self.encode_inputs(
+            node, graph_time_series_behavior, ground_motions
+        )
+        gm_num, timesteps, node_num = ground_motions.shape[0], graph_input.shape[0], node.shape[0]
+        output_dim = self.output_dim if output_index is None else output_index.shape[0]
+        output = node_input.new_empty((timesteps, gm_num * node_num, output_dim))
+
+        if state is None:
+            state = self.init_state(
+                (graph_input[0].unsqueeze(1) + node_input).reshape(gm_num * node_num, node_input.shape[1])
+            )
+        state.workspace = DecoderWorkspace(self, node_input, graph_input, ground_motions, gm_num * node_num, output_index)
+        for t in range(timesteps):
+            self.forward_one_timestep_(t, None, state, output[t])
+        state.workspace = None
+        output = output.view(timesteps, gm_num, node_num, output_dim).permute(1, 2, 0, 3)
+        if return_state:
+            return output, state
         return output
 
 
+class FusedNodeTimeSeriesDecoder(NodeTimeSeriesDecoder):
+    # Same parameters (and state_dict) as NodeTimeSeriesDecoder, but the layers run over the whole
+    # sequence one after another instead of step by step: the input of layer i at step t only depends on
+    # the output of layer i - 1 at step t (with the ground motion injected), so each layer's input
+    # sequence is known once the previous layer has run. Every layer but the last is one fused LSTM
+    # call with the weights of its LSTMCell.
+    def lstm_layer(self, i, x, H, C):
+        # x: [timesteps, node_num, node_lstm_hidden_dim], H, C: initial states [node_num, node_lstm_hidden_dim]
+        cell = self.lstmCellList[i]
+        output, H, C = torch.lstm(
+            x,
+            (H.unsqueeze(0), C.unsqueeze(0)),
+            [cell.weight_ih, cell.weight_hh, cell.bias_ih, cell.bias_hh],
+            True,
+            1,
+            0.0,
+            self.training,
+            False,
+            False,
+        )
+        return output, H[0], C[0]
+
+    def lstm_layer_with_cell_states(self, i, x, H, C):
+        # the fused LSTM only returns H, but the response also needs C of the last layer:
+        # its input projection is still done for all timesteps in one matmul, only the recurrent part loops
+        # (unbind, so the backward gathers the gradients of all steps at once)
+        cell = self.lstmCellList[i]
+        input_gates = F.linear(x, cell.weight_ih, cell.bias_ih + cell.bias_hh)
+        H_list, C_list = [], []
+        for input_gates_t in input_gates.unbind(0):
+            gates = torch.addmm(input_gates_t, H, cell.weight_hh.t())
+            input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+            C = torch.sigmoid(forget_gate) * C + torch.sigmoid(input_gate) * torch.tanh(cell_gate)
+            H = torch.sigmoid(output_gate) * torch.tanh(C)
+            H_list.append(H)
+            C_list.append(C)
+        return torch.stack(H_list, dim=0), torch.stack(C_list, dim=0)
+
+    def forward(
+        self,
+        node,
+        node_graph_index,
+        graph_time_series_behavior,
+        ground_motions,
+        state=None,
+        return_state=False,
+        output_index=None,
+    ):
+        # (no in place path, the fused layers run the same with or without autograd)
+        return self.forward_sequence(
+            node,
+            node_graph_index,
+            graph_time_series_behavior,
+            ground_motions,
+            state,
+            return_state,
+            output_index,
+        )
+
+    def decode(self, node_input, graph_input, ground_motions, node_graph_index, state):
+        # [timesteps, node_num, ...] sequences, every layer starts from the state of its previous timestep
+        x = node_input + graph_input.index_select(1, node_graph_index)
+        gms = ground_motions.permute(1, 0, 2).index_select(1, node_graph_index)
+        H_list, C_list = [], []
+
+        layer_input = x
+        for i in range(self.num_layers):
+            if i > 0:
+                layer_input = torch.cat(
+                    [H_sequence[:, :, : -self.ground_motion_dim], gms], dim=2
+                )
+            if i < self.num_layers - 1:
+                H_sequence, H, C = self.lstm_layer(i, layer_input, state.H[i], state.C[i])
+            else:
+                H_sequence, C_sequence = self.lstm_layer_with_cell_states(
+                    i, layer_input, state.H[i], state.C[i]
+                )
+                H, C = H_sequence[-1], C_sequence[-1]
+            H_list.append(H)
+            C_list.append(C)
+
+        output = self.create_response(H_sequence, C_sequence).permute(1, 0, 2)
+        return output, DecoderState(H_list, C_list)
+
+
+class GraphLSTMState(object):
+    # State of GraphLSTM between two time windows of a sequence:
+    # (h, c) of the graph LSTM and the DecoderState of the node decoder.
+    def __init__(self, graph_state, decoder_state):
+        self.graph_state = graph_state
+        self.decoder_state = decoder_state
+
+    def detach(self):
+        # cut the gradient at the window boundary (truncated backpropagation through time)
+        graph_state = tuple(state.detach() for state in self.graph_state)
+        return GraphLSTMState(graph_state, self.decoder_state.detach())
+
+
 class GraphLSTM(nn.Module):
     def __init__(
         self,
@@ -180,6 +545,8 @@ class GraphLSTM(nn.Module):
         ground_motion_dim,
         output_dim,
         device,
+        node_decoder="cell",
+        checkpoint_timesteps=0,
     ):
         super(GraphLSTM, self).__init__()
 
@@ -191,7 +558,12 @@ class GraphLSTM(nn.Module):
         self.graphTimeSeriesEncoder = GraphTimeSeriesEncoder(
             latent_dim, graph_lstm_hidden_dim, graph_lstm_num_layers, ground_motion_dim
         )
-        self.nodeTimeSeriesDecoder = NodeTimeSeriesDecoder(
+        # "cell": step by step LSTMCell loop, "fused": full-sequence LSTM per layer (same parameters)
+        node_decoder_class = {
+            "cell": NodeTimeSeriesDecoder,
+            "fused": FusedNodeTimeSeriesDecoder,
+        }[node_decoder]
+        self.nodeTimeSeriesDecoder = node_decoder_class(
             node_dim,
             graph_lstm_hidden_dim,
             ground_motion_dim,
@@ -199,24 +571,49 @@ class GraphLSTM(nn.Module):
             node_lstm_num_layers,
             output_dim,
             device,
+            checkpoint_timesteps,
         )
 
-    def sample_node(self, x, ptr, sampled_indexes, sample_node):
-        # if don't samplem, return original x and sampled_indexes=all index
+    def sample_node(self, x, batch, sampled_node_index, sample_node):
+        # sampled_node_index: [sampled_num] indexes of the sampled nodes in the batch
+        # (collated by the DataLoader, which offsets each graph's indexes by its first node)
+        # returns the sampled x, their indexes and the graph of each of them
         if not sample_node:
-            keeped_indexes = [i for i in range(x.shape[0])]
-            return x, keeped_indexes, ptr
-
-        # sampled_indexes = [sampled_index for i in batch_size]
-        bs = len(ptr) - 1
-        keeped_indexes = []
-        new_ptr = [0]
-        for b in range(bs):
-            sampled_index = sampled_indexes[b]
-            keeped_indexes += [(ptr[b] + index).item() for index in sampled_index]
-            new_ptr.append(new_ptr[-1] + len(sampled_index))
-        x = x[keeped_indexes]
-        return x, keeped_indexes, new_ptr
+            keeped_indexes = torch.arange(x.shape[0], device=x.device)
+            return x, keeped_indexes, batch
+
+        keeped_indexes = sampled_node_index
+        x = x.index_select(0, keeped_indexes)
+        return x, keeped_indexes, batch.index_select(0, keeped_indexes)
+
+    def encode(self, x, edge_index, edge_attr, batch, sampled_node_index, sample_node=True):
+        # graph latent and the (sampled) nodes to decode, shared by every time window of the batch
+        latent, _, _ = self.graphLatentEncoder(x, edge_index, edge_attr, batch)
+        node, keeped_indexes, node_graph_index = self.sample_node(
+            x, batch, sampled_node_index, sample_node
+        )
+        return latent, node, keeped_indexes, node_graph_index
+
+    def forward_window(self, latent, node, node_graph_index, ground_motions, state=None, output_index=None):
+        # the next timesteps of the sequence, ground_motions: [batch_size, window, ground_motion_dim],
+        # starting from the state after the previous window (None: start of the sequence)
+        # output_index: only these output channels are returned (all if None)
+        graph_state = None if state is None else state.graph_state
+        decoder_state = None if state is None else state.decoder_state
+
+        graph_time_series_behavior, graph_state = self.graphTimeSeriesEncoder(
+            latent, ground_motions, graph_state, return_state=True
+        )
+        output, decoder_state = self.nodeTimeSeriesDecoder(
+            node,
+            node_graph_index,
+            graph_time_series_behavior,
+            ground_motions,
+            decoder_state,
+            return_state=True,
+            output_index=output_index,
+        )
+        return output, GraphLSTMState(graph_state, decoder_state)
 
     def forward(
         self,
@@ -225,22 +622,35 @@ class GraphLSTM(nn.Module):
         edge_attr,
         batch,
         ptr,
-        sampled_indexes,
+        sampled_node_index,
         ground_motions,
         sample_node=True,
+        output_index=None,
     ):
-        # graph latent
-        latent, _, _ = self.graphLatentEncoder(x, edge_index, edge_attr, batch)
+        # (ptr is not used anymore, the graph of each node comes from batch)
+        # output_index: only these output channels are returned (all if None)
+        # graph latent, sample node
+        latent, x, keeped_indexes, node_graph_index = self.encode(
+            x, edge_index, edge_attr, batch, sampled_node_index, sample_node
+        )
 
-        # graph level time series behavior
-        graph_time_series_behavior = self.graphTimeSeriesEncoder(latent, ground_motions)
+        # graph level time series behavior, node level time series prediction
+        output, _ = self.forward_window(latent, x, node_graph_index, ground_motions, output_index=output_index)
 
-        # sample node
-        x, keeped_indexes, ptr = self.sample_node(x, ptr, sampled_indexes, sample_node)
+        return output, keeped_indexes
 
-        # node level time series prediction
-        output = self.nodeTimeSeriesDecoder(
-            x, ptr, graph_time_series_behavior, ground_motions
+    @torch.no_grad()
+    def forward_ground_motions(self, x, edge_index, edge_attr, ground_motions, node_index=None, output_index=None):
+        # inference of one structure under a batch of ground motions [gm_num, timesteps, ground_motion_dim]:
+        # the nodes (all, or node_index) and the latent are shared by every ground motion instead of being
+        # collated gm_num times, returns [gm_num, node_num, timesteps, output_dim]
+        # (selective output: only the nodes of node_index are decoded, only the channels of output_index projected)
+        batch = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        latent, _, _ = self.graphLatentEncoder(x, edge_index, edge_attr, batch)
+        node = x if node_index is None else x.index_select(0, node_index)
+        graph_time_series_behavior = self.graphTimeSeriesEncoder(
+            latent.expand(ground_motions.shape[0], -1), ground_motions
+        )
+        return self.nodeTimeSeriesDecoder.forward_ground_motions(
+            node, graph_time_series_behavior, ground_motions, output_index=output_index
         )
-
-        return output, keeped_indexes
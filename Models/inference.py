@@ -0,0 +1,240 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from collections import OrderedDict
+from copy import deepcopy
+from typing import List, Optional
+import hashlib
+from .LSTM import lstm_cell_
+
+
+# Standalone inference artifact of a trained GraphLSTM: a TorchScript module saved next to model_Best.pt
+# that only needs torch (and the ops of torch_geometric) to run, not the training code:
+#   model = torch.jit.load("model_Best_inference.pt")
+#   output = model(x, edge_index, edge_attr, batch, ground_motions)    # [node_num, timesteps, output_dim]
+
+
+class NodeEmbedding(nn.Module):
+    # GATv2 layers of GraphLatentEncoder without the pooling,
+    # GATv2Conv can't be scripted so this part is traced (the trace holds for any graph size).
+    def __init__(self, graphLatentEncoder):
+        super(NodeEmbedding, self).__init__()
+        self.conv_layers = graphLatentEncoder.conv_layers
+
+    def forward(self, x, edge_index, edge_attr):
+        for conv in self.conv_layers:
+            x = conv(x, edge_index, edge_attr)
+        return x
+
+
+class GraphLSTMInference(nn.Module):
+    # GraphLSTM forward without node sampling (or on the nodes of node_index), with the node decoder
+    # running in place on preallocated buffers like NodeTimeSeriesDecoder under torch.no_grad().
+    def __init__(self, model, node_embedding):
+        super(GraphLSTMInference, self).__init__()
+        decoder = model.nodeTimeSeriesDecoder
+        self.node_embedding = node_embedding
+        self.graph_lstm = model.graphTimeSeriesEncoder.lstm
+        self.node_dim = decoder.node_dim
+        self.ground_motion_dim = decoder.ground_motion_dim
+        self.num_layers = decoder.num_layers
+        self.output_dim = decoder.output_dim
+
+        node_encoder = decoder.node_encoder.module_list[0]
+        self.register_buffer("node_weight", node_encoder.weight[:, : self.node_dim].detach().clone())
+        self.register_buffer("node_bias", node_encoder.bias.detach().clone())
+        self.register_buffer("graph_weight", node_encoder.weight[:, self.node_dim :].detach().clone())
+
+        # LSTMCell weights of every layer: [num_layers, 4 * hidden, hidden]
+        cells = decoder.lstmCellList
+        self.register_buffer("weight_ih", torch.stack([cell.weight_ih.detach() for cell in cells]))
+        self.register_buffer("weight_hh", torch.stack([cell.weight_hh.detach() for cell in cells]))
+        self.register_buffer("bias", torch.stack([(cell.bias_ih + cell.bias_hh).detach() for cell in cells]))
+
+        hidden_layer, output_layer = decoder.response_decoder.module_list
+        hidden_dim = cells[0].hidden_size
+        self.register_buffer("response_weight_H", hidden_layer.weight[:, :hidden_dim].t().detach().clone())
+        self.register_buffer("response_weight_C", hidden_layer.weight[:, hidden_dim:].t().detach().clone())
+        self.register_buffer("response_bias", hidden_layer.bias.detach().clone())
+        self.register_buffer("output_weight", output_layer.weight.t().detach().clone())
+        self.register_buffer("output_bias", output_layer.bias.detach().clone())
+
+    def encode(self, x, edge_index, edge_attr, batch, ground_motions):
+        # graph latent (mean of the node embeddings of each graph) and graph level time series behavior
+        node_embedding = self.node_embedding(x, edge_index, edge_attr)
+        graph_num = ground_motions.shape[0]
+        latent = node_embedding.new_zeros((graph_num, node_embedding.shape[1])).index_add_(0, batch, node_embedding)
+        node_count = node_embedding.new_zeros(graph_num).index_add_(0, batch, node_embedding.new_ones(batch.shape[0]))
+        latent = latent / node_count.clamp(min=1).unsqueeze(1)
+
+        timesteps = ground_motions.shape[1]
+        latent = latent.unsqueeze(1).expand(-1, timesteps, -1)
+        graph_time_series_behavior, _ = self.graph_lstm(torch.cat([latent, ground_motions], dim=2))
+        return graph_time_series_behavior
+
+    def decode(self, node, node_graph_index, graph_time_series_behavior, ground_motions):
+        node_input = F.linear(node, self.node_weight, self.node_bias)
+        graph_input = F.linear(torch.cat([graph_time_series_behavior, ground_motions], dim=2).permute(1, 0, 2), self.graph_weight)
+        gms = ground_motions.permute(1, 0, 2)
+        gm_dim = self.ground_motion_dim
+
+        # input gates of every timestep per graph (see DecoderWorkspace)
+        node_gates = F.linear(node_input, self.weight_ih[0], self.bias[0])
+        input_gates: List[torch.Tensor] = [F.linear(graph_input, self.weight_ih[0])]
+        for i in range(1, self.num_layers):
+            input_gates.append(F.linear(gms, self.weight_ih[i][:, -gm_dim:], self.bias[i]))
+
+        x = node_input + graph_input[0].index_select(0, node_graph_index)
+        H: List[torch.Tensor] = [x.clone() for _ in range(self.num_layers)]
+        C: List[torch.Tensor] = [x.clone() for _ in range(self.num_layers)]
+        timesteps = graph_input.shape[0]
+        node_num = node_input.shape[0]
+        gates = node_input.new_empty((node_num, self.weight_ih.shape[1]))
+        hidden = node_input.new_empty((node_num, self.response_bias.shape[0]))
+        output = node_input.new_empty((timesteps, node_num, self.output_dim))
+
+        for t in range(timesteps):
+            for i in range(self.num_layers):
+                # (the aten op, torch_geometric replaces torch.index_select with a python function)
+                torch.ops.aten.index_select(input_gates[i][t], 0, node_graph_index, out=gates)
+                if i == 0:
+                    gates.add_(node_gates)
+                else:
+                    gates.addmm_(H[i - 1][:, :-gm_dim], self.weight_ih[i][:, :-gm_dim].t())
+                gates.addmm_(H[i], self.weight_hh[i].t())
+                lstm_cell_(gates, H[i], C[i])
+
+            torch.addmm(self.response_bias, H[-1], self.response_weight_H, out=hidden)
+            hidden.addmm_(C[-1], self.response_weight_C).relu_()
+            torch.addmm(self.output_bias, hidden, self.output_weight, out=output[t])
+        return output.permute(1, 0, 2)
+
+    def forward(self, x, edge_index, edge_attr, batch, ground_motions, node_index: Optional[torch.Tensor] = None):
+        # x: [node_num, node_dim], batch: [node_num] graph of each node, ground_motions: [batch_size, timesteps, ground_motion_dim]
+        # node_index: the nodes to predict (all nodes if None)
+        with torch.no_grad():
+            graph_time_series_behavior = self.encode(x, edge_index, edge_attr, batch, ground_motions)
+            node, node_graph_index = x, batch
+            if node_index is not None:
+                node, node_graph_index = x.index_select(0, node_index), batch.index_select(0, node_index)
+            return self.decode(node, node_graph_index, graph_time_series_behavior, ground_motions)
+
+
+
+def example_graph(node_dim, edge_dim, node_num=8):
+    # a chain of nodes with both edge directions, only used to trace the GNN layers
+    source = torch.arange(node_num - 1)
+    edge_index = torch.cat([torch.stack([source, source + 1]), torch.stack([source + 1, source])], dim=1)
+    return torch.rand(node_num, node_dim), edge_index, torch.rand(edge_index.shape[1], edge_dim)
+
+
+
+def export_inference_model(model, path=None):
+    # script the inference module of a GraphLSTM on CPU, and save it if path is given
+    model = deepcopy(model).cpu().eval()
+    conv = model.graphLatentEncoder.conv_layers[0]
+    with torch.no_grad():
+        node_embedding = torch.jit.trace(NodeEmbedding(model.graphLatentEncoder),
+                                         example_graph(conv.in_channels, conv.edge_dim), check_trace=False)
+    inference_model = torch.jit.script(GraphLSTMInference(model, node_embedding))
+    if path is not None:
+        torch.jit.save(inference_model, str(path))
+    return inference_model
+
+
+
+def load_inference_model(path):
+    return torch.jit.load(str(path), map_location="cpu")
+
+
+
+# Sweeps of one structure under many ground motions (e.g. every record pair of a fragility study):
+# the structure encoding only depends on x / edge_index / edge_attr, so it is computed once per structure
+# and fanned out over a batch of ground motions, instead of running the GNN for every (structure, record) graph.
+#   cache = StructureEncodingCache(model)
+#   output = predict_ground_motions(model, x, edge_index, edge_attr, ground_motions, cache)   # [gm_num, node_num, timesteps, output_dim]
+
+
+class StructureEncoding(object):
+    # graph latent [1, latent_dim] of a structure, and the flat weights of the graph LSTM with the latent's
+    # part of the first layer's input projection folded into its bias (the latent is the same at every
+    # timestep and for every ground motion, so the LSTM only has to project the ground motions)
+    def __init__(self, latent, graph_lstm_weights):
+        self.latent = latent
+        self.graph_lstm_weights = graph_lstm_weights
+
+
+def graph_content_hash(x, edge_index, edge_attr):
+    digest = hashlib.blake2b(digest_size=16)
+    for tensor in (x, edge_index, edge_attr):
+        tensor = tensor.detach().contiguous().cpu()
+        digest.update(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def encode_structure(model, x, edge_index, edge_attr):
+    batch = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+    latent, _, _ = model.graphLatentEncoder(x, edge_index, edge_attr, batch)
+    lstm = model.graphTimeSeriesEncoder.lstm
+    latent_dim = latent.shape[1]
+    weights = [weight for layer_weights in lstm.all_weights for weight in layer_weights]
+    weights[2] = weights[2] + F.linear(latent[0], weights[0][:, :latent_dim])
+    weights[0] = weights[0][:, latent_dim:].contiguous()
+    return StructureEncoding(latent, weights)
+
+
+class StructureEncodingCache(object):
+    # LRU cache of the StructureEncoding of the last max_size structures of one (trained, eval mode) model,
+    # keyed by a hash of the graph's content, so the same structure passed again (another sweep, another
+    # scenario) skips the GNN even if it is a different tensor
+    def __init__(self, model, max_size=64):
+        self.model = model
+        self.max_size = max_size
+        self.encodings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, x, edge_index, edge_attr):
+        key = graph_content_hash(x, edge_index, edge_attr)
+        if key in self.encodings:
+            self.hits += 1
+            self.encodings.move_to_end(key)
+            return self.encodings[key]
+        self.misses += 1
+        encoding = encode_structure(self.model, x, edge_index, edge_attr)
+        self.encodings[key] = encoding
+        if len(self.encodings) > self.max_size:
+            self.encodings.popitem(last=False)
+        return encoding
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def clear(self):
+        self.encodings.clear()
+
+
+@torch.no_grad()
+def fan_out(model, encoding, x, ground_motions, node_index=None, output_index=None):
+    # responses of one structure (x: [node_num, node_dim]) under each of ground_motions [gm_num, timesteps, ground_motion_dim]
+    lstm = model.graphTimeSeriesEncoder.lstm
+    gm_num = ground_motions.shape[0]
+    ground_motions = ground_motions.to(encoding.graph_lstm_weights[0].dtype)
+    state = ground_motions.new_zeros((lstm.num_layers, gm_num, lstm.hidden_size))
+    graph_time_series_behavior, _, _ = torch.lstm(ground_motions, (state, state), encoding.graph_lstm_weights,
+                                                  True, lstm.num_layers, 0.0, False, False, True)
+
+    # the nodes are shared by every ground motion (see GraphLSTM.forward_ground_motions)
+    node = x if node_index is None else x.index_select(0, node_index)
+    return model.nodeTimeSeriesDecoder.forward_ground_motions(node, graph_time_series_behavior, ground_motions, output_index=output_index)
+
+
+def predict_ground_motions(model, x, edge_index, edge_attr, ground_motions, cache=None, node_index=None, batch_size=0, output_index=None):
+    # fan_out of the (cached) encoding of the structure, batch_size ground motions at a time (0: all at once)
+    encoding = cache(x, edge_index, edge_attr) if cache is not None else encode_structure(model, x, edge_index, edge_attr)
+    batch_size = batch_size if batch_size > 0 else ground_motions.shape[0]
+    outputs = [fan_out(model, encoding, x, ground_motions[i : i + batch_size], node_index, output_index)
+               for i in range(0, ground_motions.shape[0], batch_size)]
+    return torch.cat(outputs, dim=0)
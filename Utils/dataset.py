@@ -1,71 +1,175 @@
 import torch
+import torch.multiprocessing as mp
 from torch.utils.data import Dataset
 from torch_geometric.data import Data
+import numpy as np
 import random
+import json
 import os
 from os import listdir
 from os.path import join
 from tqdm import tqdm
 import sys
 # sys.path.append("../")
+from .ground_motion import GroundMotionBank, ground_motion_record_id, ground_motion_pair_ids, ground_motion_record_path, orthogonal_ground_motion_name
+
+
+# Folder of the processed ground motion records referenced by record id in ground_motion.json.
+GROUND_MOTION_ROOT = "../Data/Ground_Motion"
+
+# Version of the compiled dataset cache layout, bump it when the layout changes.
+CACHE_VERSION = 4
+CACHE_INDEX = "index.json"
+CACHE_STATISTICS = "statistics.json"
+
+# Storage dtypes of y and the ground motions in the cache (the other fields keep their own dtype),
+# numpy has no bfloat16 so it is stored as the raw 16 bits (int16) and viewed back as bfloat16.
+# (no float16: y is stored unnormalized and the moments in kN-mm exceed its maximum of 65504)
+STORAGE_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+STORAGE_FIELDS = ("y", "ground_motions")
+
+
+def to_storage(tensor, dtype, name=""):
+    tensor = tensor.to(STORAGE_DTYPES[dtype])
+    if not torch.isfinite(tensor).all():
+        raise ValueError(f"{name} has values that are not finite in {dtype} storage")
+    if dtype == "bfloat16":
+        return tensor.view(torch.int16).numpy()
+    return tensor.numpy()
+
+
+def from_storage(array, dtype):
+    tensor = torch.from_numpy(array)
+    if dtype == "bfloat16":
+        return tensor.view(torch.bfloat16)
+    return tensor
+
+
+def numpy_dtype(dtype):
+    return "int16" if dtype == "bfloat16" else dtype
+
+
+def select_folders(folder, other_folders, data_num):
+    random.seed(731)
+    all_folders = os.listdir(folder)
+    all_folders = [join(folder, f) for f in all_folders]
+    for other_folder in other_folders:
+        other_folder_list = os.listdir(other_folder)
+        other_folder_list = [join(other_folder, f) for f in other_folder_list]
+        all_folders += other_folder_list
+    random.shuffle(all_folders)
+    return all_folders[:data_num]
+
+
+
+# Structure folders either carry their own copy of the records (ground_motion_1.txt, ground_motion_2.txt)
+# or only reference them by record id in ground_motion.json (written by generate_random_structure),
+# the referenced records are read from ground_motion_root.
+def ground_motion_paths(folder_name, ground_motion_root=GROUND_MOTION_ROOT):
+    gm_path_1 = join(folder_name, "ground_motion_1.txt")
+    gm_path_2 = join(folder_name, "ground_motion_2.txt")
+    if os.path.exists(gm_path_1) and os.path.exists(gm_path_2):
+        return gm_path_1, gm_path_2
+    with open(join(folder_name, "ground_motion.json"), "r") as f:
+        reference = json.load(f)
+    return (ground_motion_record_path(reference["record_id_1"], ground_motion_root),
+            ground_motion_record_path(reference["record_id_2"], ground_motion_root))
+
+
+
+def load_graph(folder_name, graph_type, timesteps, ground_motion_bank, ground_motion_root=GROUND_MOTION_ROOT):
+    graph_path = join(folder_name, f"structure_graph_{graph_type}.pt")
+    if os.path.exists(graph_path) == False:
+        print(f"There's no {graph_path}!")
+        return None
+    graph = torch.load(graph_path)
+    graph.path = folder_name
+
+    # the graph only keeps the row of its ground motion pair in the bank
+    # (a graph without gm name can't share its records, so its folder is used as the key)
+    gm_path_1, gm_path_2 = ground_motion_paths(folder_name, ground_motion_root)
+    record_id = ground_motion_record_id(graph.gm_X_name) or folder_name
+    gm_row = ground_motion_bank.add(record_id, gm_path_1, gm_path_2, *ground_motion_pair_ids(graph.gm_X_name))
+    graph.gm_row = torch.tensor([gm_row])
+    ground_motions = ground_motion_bank.pairs[gm_row]
+
+    # only the first timesteps of the responses are kept, like the ground motions in the bank
+    graph.y = graph.y[:, :timesteps, :]
+    ground_motions = ground_motions[:graph.y.shape[1]]
+
+    # AbsAcc = RelAcc + GroundMotionAcc (PISA outputs response every 10 steps: 0, 10, 20,...)
+    new_y = torch.zeros(graph.y.shape)
+    new_y[:, :, 0] = graph.y[:, :, 0] + ground_motions[:, 0]   # ground_motion_1[:, 0]
+    new_y[:, :, 1] = graph.y[:, :, 1] + ground_motions[:, 10]  # ground_motion_2[:, 0]
+    new_y[:, :, 2:] = graph.y[:, :, 2:]
+    graph.y = new_y
+
+    return graph
+
+
+
+# Parallel loading: each worker process parses whole structure folders with its own ground motion bank,
+# the graphs come back through torch.multiprocessing (tensors are passed in shared memory, not pickled)
+# in chunks of chunk_size folders, and the main process moves their gm_row to the shared bank.
+_worker_ground_motion_bank = None
+
+def _init_load_worker():
+    torch.set_num_threads(1)
+
+
+def _load_graph_in_worker(task):
+    global _worker_ground_motion_bank
+    folder_name, graph_type, timesteps, ground_motion_root = task
+    if _worker_ground_motion_bank is None or _worker_ground_motion_bank.timesteps != timesteps:
+        _worker_ground_motion_bank = GroundMotionBank(timesteps)
+    graph = load_graph(folder_name, graph_type, timesteps, _worker_ground_motion_bank, ground_motion_root)
+    if graph is None:
+        return None
+    return graph, _worker_ground_motion_bank.record_ids[graph.gm_row.item()]
+
+
+
+# Yield the graphs of the selected folders in order, num_workers=0 loads them in this process.
+def load_graphs(selected_folders, graph_type, timesteps, ground_motion_bank, num_workers=0, chunk_size=8, ground_motion_root=GROUND_MOTION_ROOT):
+    if num_workers == 0:
+        for folder_name in tqdm(selected_folders):
+            graph = load_graph(folder_name, graph_type, timesteps, ground_motion_bank, ground_motion_root)
+            if graph is None:
+                continue
+            yield graph
+        return
+
+    tasks = [(folder_name, graph_type, timesteps, ground_motion_root) for folder_name in selected_folders]
+    with mp.get_context("spawn").Pool(num_workers, initializer=_init_load_worker) as pool:
+        for result in tqdm(pool.imap(_load_graph_in_worker, tasks, chunksize=chunk_size), total=len(tasks)):
+            if result is None:
+                continue
+            graph, record_id = result
+            gm_row = ground_motion_bank.add(record_id, *ground_motion_paths(graph.path, ground_motion_root), *ground_motion_pair_ids(graph.gm_X_name))
+            graph.gm_row = torch.tensor([gm_row])
+            yield graph
+
 
 
 class GroundMotionDataset(Dataset):
-    def __init__(self, folder="Linear_Dynamic_Analysis", graph_type="NodeAsNode", data_num=5, timesteps=2000, other_folders=[]):
+    def __init__(self, folder="Linear_Dynamic_Analysis", graph_type="NodeAsNode", data_num=5, timesteps=2000, other_folders=[], num_workers=0,
+                 ground_motion_root=GROUND_MOTION_ROOT):
         self.root = "../Data"
         folder = join(self.root, folder)
         other_folders = [join(self.root, other_folder) for other_folder in other_folders]
         self.folder = folder
         self.other_folders = other_folders
         self.data_num = data_num
+        self.num_workers = num_workers
+        self.ground_motion_root = ground_motion_root
+        self.ground_motion_bank = GroundMotionBank(timesteps)
         self.graphs = self.load(self.folder, graph_type, data_num, timesteps)
 
 
     def load(self, folder, graph_type, data_num, timesteps):
-        max_steps = 2000
-        batch = 10
-        graphs = []
-
-        random.seed(731)
-        all_folders = os.listdir(folder)
-        all_folders = [join(folder, f) for f in all_folders]
-        for other_folder in self.other_folders:
-            other_folders = os.listdir(other_folder)
-            other_folders = [join(other_folder, f) for f in other_folders]
-            all_folders += other_folders
-        random.shuffle(all_folders)
-        selected_folders = all_folders[:data_num]
-        for folder_name in tqdm(selected_folders):
-            gm_path_1 = join(folder_name, "ground_motion_1.txt")
-            gm_path_2 = join(folder_name, "ground_motion_2.txt")
-            graph_path = join(folder_name, f"structure_graph_{graph_type}.pt")
-            if os.path.exists(graph_path) == False:
-                print(f"There's no {graph_path}!")
-                continue
-            ground_motion_1 = torch.zeros((max_steps, batch))
-            ground_motion_2 = torch.zeros((max_steps, batch))
-            with open(gm_path_1, "r") as f:
-                for index, line in enumerate(f.readlines()):
-                    i, j = index//10, index%10
-                    ground_motion_1[i, j] = float(line.split()[1])
-            with open(gm_path_2, "r") as f:
-                for index, line in enumerate(f.readlines()):
-                    i, j = index//10, index%10
-                    ground_motion_2[i, j] = float(line.split()[1])
-            graph = torch.load(graph_path)
-            graph.path = folder_name
-            graph.ground_motion_1 = ground_motion_1[:timesteps, :]
-            graph.ground_motion_2 = ground_motion_2[:timesteps, :]
-            
-            # AbsAcc = RelAcc + GroundMotionAcc (PISA outputs response every 10 steps: 0, 10, 20,...)
-            new_y = torch.zeros(graph.y.shape)
-            new_y[:, :, 0] = graph.y[:, :, 0] + graph.ground_motion_1[:, 0]  # torch.mean(graph.ground_motion_1, dim=1)
-            new_y[:, :, 1] = graph.y[:, :, 1] + graph.ground_motion_2[:, 0]  # torch.mean(graph.ground_motion_2, dim=1)
-            new_y[:, :, 2:] = graph.y[:, :, 2:]
-            graph.y = new_y
-
-            graphs.append(graph)
-            
+        selected_folders = select_folders(folder, self.other_folders, data_num)
+        graphs = list(load_graphs(selected_folders, graph_type, timesteps, self.ground_motion_bank, self.num_workers,
+                                  ground_motion_root=self.ground_motion_root))
         return graphs
 
 
@@ -77,3 +181,158 @@ class GroundMotionDataset(Dataset):
         return self.graphs[i]
 
 
+
+
+# Compiled dataset cache
+# The cache is a folder with one raw binary file per field, every graph's rows are appended to
+# the same file (x, y: node rows, edge_index, edge_attr: edge rows), the ground motion bank is
+# stored once (ground_motions: pair rows), and an index.json records the layout, the row offsets,
+# the record id of each bank row, the string attributes of each graph and the compile parameters.
+# storage_dtype ("float32", "float16", "bfloat16") is the dtype of y and the ground motions in the files.
+def cache_parameters(folder, graph_type, data_num, timesteps, other_folders, storage_dtype):
+    return {"folder": folder, "other_folders": list(other_folders), "graph_type": graph_type, "data_num": data_num,
+            "timesteps": timesteps, "storage_dtype": storage_dtype}
+
+
+def compile_dataset(cache_dir, folder="Linear_Dynamic_Analysis", graph_type="NodeAsNode", data_num=5, timesteps=2000, other_folders=[], num_workers=0,
+                    storage_dtype="float32", ground_motion_root=GROUND_MOTION_ROOT):
+    parameters = cache_parameters(folder, graph_type, data_num, timesteps, other_folders, storage_dtype)
+    root = "../Data"
+    folder = join(root, folder)
+    other_folders = [join(root, other_folder) for other_folder in other_folders]
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(f"storage dtype {storage_dtype}, expected one of {list(STORAGE_DTYPES.keys())}")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # rewrite the index last, so an interrupted compile never looks complete
+    # (the statistics of the previous graphs are dropped with it)
+    index_path = join(cache_dir, CACHE_INDEX)
+    for path in [index_path, join(cache_dir, CACHE_STATISTICS)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    fields = {"x": None, "edge_index": None, "edge_attr": None, "y": None}
+    files = {name: open(join(cache_dir, f"{name}.bin"), "wb") for name in fields.keys()}
+    rows = {name: 0 for name in fields.keys()}
+    graphs = []
+    ground_motion_bank = GroundMotionBank(timesteps)
+
+    selected_folders = select_folders(folder, other_folders, data_num)
+    try:
+        for graph in load_graphs(selected_folders, graph_type, timesteps, ground_motion_bank, num_workers, ground_motion_root=ground_motion_root):
+            arrays = {"x": graph.x.numpy(),
+                      "edge_index": graph.edge_index.t().contiguous().numpy(),
+                      "edge_attr": graph.edge_attr.numpy(),
+                      "y": to_storage(graph.y, storage_dtype, f"{graph.path}: y")}
+
+            # (the generated graphs don't keep gm_Z_name, it is derived like in normalization)
+            graphs.append({"path": graph.path,
+                           "gm_X_name": graph.gm_X_name,
+                           "gm_Z_name": orthogonal_ground_motion_name(graph.gm_X_name),
+                           "grid_num": graph.grid_num.tolist(),
+                           "gm_row": graph.gm_row.item(),
+                           "node_offset": rows["x"], "node_num": arrays["x"].shape[0],
+                           "edge_offset": rows["edge_index"], "edge_num": arrays["edge_index"].shape[0]})
+
+            for name, array in arrays.items():
+                # every graph must share the trailing shape of a field to be stored in one file
+                dtype = storage_dtype if name in STORAGE_FIELDS else str(array.dtype)
+                if fields[name] is None:
+                    fields[name] = {"dtype": dtype, "shape": list(array.shape[1:])}
+                elif fields[name]["shape"] != list(array.shape[1:]) or fields[name]["dtype"] != dtype:
+                    raise ValueError(f"{graph.path}: {name} {dtype}{list(array.shape)} does not match the cache layout {fields[name]}")
+                files[name].write(np.ascontiguousarray(array).tobytes())
+                rows[name] += array.shape[0]
+    finally:
+        for f in files.values():
+            f.close()
+
+    for name in fields.keys():
+        if fields[name] is not None:
+            fields[name]["shape"] = [rows[name]] + fields[name]["shape"]
+
+    ground_motions = to_storage(ground_motion_bank.ground_motions, storage_dtype, "ground_motions")
+    with open(join(cache_dir, "ground_motions.bin"), "wb") as f:
+        f.write(np.ascontiguousarray(ground_motions).tobytes())
+    fields["ground_motions"] = {"dtype": storage_dtype, "shape": list(ground_motions.shape)}
+
+    index = {"version": CACHE_VERSION, "graph_type": graph_type, "timesteps": timesteps, "parameters": parameters,
+             "fields": fields, "ground_motion_ids": ground_motion_bank.record_ids, "graphs": graphs}
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+
+    return index_path
+
+
+
+class CompiledGroundMotionDataset(Dataset):
+    # With mmap=True, y and the ground motions of a graph are views over the cache files instead of
+    # in-memory copies, pages are read when a batch touches them and dropped by the OS afterwards.
+    # They keep the storage dtype of the cache (compile_dataset's storage_dtype) until the per batch
+    # normalization casts them to float32, in memory they are always float32.
+    mmap_fields = ("y", "ground_motions")
+
+    # parameters: the cache_parameters the cache is expected to be compiled with (not checked if None)
+    def __init__(self, cache_dir, mmap=False, parameters=None):
+        self.cache_dir = cache_dir
+        self.mmap = mmap
+        with open(join(cache_dir, CACHE_INDEX), "r") as f:
+            index = json.load(f)
+        if index["version"] != CACHE_VERSION:
+            raise ValueError(f"dataset cache version {index['version']} in {cache_dir}, expected {CACHE_VERSION}, please compile it again")
+        if parameters is not None:
+            mismatches = [f"{name} {index['parameters'].get(name)} (expected {value})" for name, value in parameters.items()
+                          if index["parameters"].get(name) != value]
+            if len(mismatches) > 0:
+                raise ValueError(f"dataset cache {cache_dir} was compiled with {', '.join(mismatches)}, "
+                                 f"remove {join(cache_dir, CACHE_INDEX)} to compile it again")
+        self.index = index
+        self.graph_infos = index["graphs"]
+        self.timesteps = index["timesteps"]
+
+        # open every field lazily, graphs are only read from disk in __getitem__
+        # (copy-on-write mode keeps the views writable without ever changing the cache files)
+        self.fields = {}
+        for name, field in index["fields"].items():
+            mode = "c" if mmap and name in self.mmap_fields else "r"
+            self.fields[name] = np.memmap(join(cache_dir, f"{name}.bin"), dtype=numpy_dtype(field["dtype"]), mode=mode, shape=tuple(field["shape"]))
+        self.storage_dtype = index["fields"]["ground_motions"]["dtype"]
+        self.paths = [info["path"] for info in self.graph_infos]
+        self.ground_motion_bank = GroundMotionBank(self.timesteps, record_ids=index["ground_motion_ids"],
+                                                   ground_motions=self.read("ground_motions", 0, len(index["ground_motion_ids"])))
+
+
+    def read(self, name, start, end):
+        dtype = self.index["fields"][name]["dtype"]
+        if self.mmap and name in self.mmap_fields:
+            return from_storage(self.fields[name][start:end], dtype)
+        tensor = from_storage(np.array(self.fields[name][start:end]), dtype)
+        return tensor.float() if name in STORAGE_FIELDS else tensor
+
+
+    def topology(self, i):
+        # the node grid columns of x (x[:, :6]), grid_num and path of graph i, without reading its y
+        info = self.graph_infos[i]
+        x = torch.from_numpy(np.array(self.fields["x"][info["node_offset"] : info["node_offset"] + info["node_num"], :6]))
+        return x, torch.tensor(info["grid_num"]), info["path"]
+
+
+    def __len__(self):
+        return len(self.graph_infos)
+
+
+    def __getitem__(self, i):
+        if i < -len(self) or i >= len(self):
+            raise IndexError(f"graph index {i} out of range for {len(self)} graphs")
+        i = i % len(self)
+        info = self.graph_infos[i]
+        node_start, node_end = info["node_offset"], info["node_offset"] + info["node_num"]
+        edge_start, edge_end = info["edge_offset"], info["edge_offset"] + info["edge_num"]
+
+        graph = Data(x=self.read("x", node_start, node_end),
+                     y=self.read("y", node_start, node_end),
+                     edge_index=self.read("edge_index", edge_start, edge_end).t().contiguous(),
+                     edge_attr=self.read("edge_attr", edge_start, edge_end),
+                     grid_num=torch.tensor(info["grid_num"]), gm_row=torch.tensor([info["gm_row"]]),
+                     path=info["path"], gm_X_name=info["gm_X_name"], gm_Z_name=info["gm_Z_name"])
+        return graph
@@ -0,0 +1,94 @@
+import torch
+import torch.distributed as dist
+import os
+
+
+# Distributed data parallel training, one process per worker started by torchrun, e.g. on one host:
+#   torchrun --nproc_per_node 4 train.py --dataset_cache ...
+# or across hosts (run on every host with its own --node_rank):
+#   torchrun --nnodes 2 --node_rank 0 --nproc_per_node 4 --master_addr <host 0> --master_port 29500 train.py ...
+# Without torchrun (no WORLD_SIZE in the environment) everything below is a no-op for a single process.
+
+
+def init_distributed(backend="gloo"):
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method="env://")
+    return get_rank(), get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    # logging, checkpoints and records are only written by rank 0
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    # the object of rank src on every rank (e.g. the checkpoint folder named after rank 0's start time)
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_reduce_sum(values):
+    # sum of a list of numbers over every rank, the metrics are accumulated as sums then averaged
+    # by the summed batch count, so they are the same as one process over all the batches
+    values = [float(value) for value in values]
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_reduce_target_accuracy(target_accuracy_record, epoch, t_v=0):
+    targets = list(target_accuracy_record.keys())
+    values = all_reduce_sum([target_accuracy_record[target][t_v][epoch] for target in targets])
+    for target, value in zip(targets, values):
+        target_accuracy_record[target][t_v][epoch] = value
+    return target_accuracy_record
+
+
+def all_reduce_plastic_hinge(classifier):
+    # [TP, FP, FN, TN] counts of a PlasticHingeClassifier
+    classifier.section_accuracy_Mz = [int(value) for value in all_reduce_sum(classifier.section_accuracy_Mz)]
+    return classifier
+
+
+def all_reduce_gradients(model):
+    # average the gradients over the ranks, for backward passes that don't go through the
+    # DistributedDataParallel forward (truncated BPTT windows)
+    if not is_distributed():
+        return
+    world_size = get_world_size()
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+            param.grad.div_(world_size)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,119 @@
+import numpy as np
+import torch
+import os
+
+
+# Ground motion record files have two whitespace separated columns: time (sec), acceleration (mm/s^2).
+def read_ground_motion(path, return_time=False):
+    record = np.loadtxt(path, ndmin=2)
+    if return_time:
+        return record[:, 0], record[:, 1]
+    return record[:, 1]
+
+
+
+# Fold the record into [max_steps, batch]: row i holds samples i*batch ~ (i+1)*batch-1,
+# zero padded after the end of the record (one row per response output step of PISA).
+def fold_ground_motion(gm, max_steps=2000, batch=10):
+    folded = np.zeros(max_steps * batch, dtype=np.float32)
+    length = min(len(gm), max_steps * batch)
+    folded[:length] = gm[:length]
+    return folded.reshape(max_steps, batch)
+
+
+
+# Record id of a ground motion name like ".../GroundMotions_World_processed_BSE-2\EQ786\EQ786_FN.txt",
+# the scaled level folder is kept since the same EQ is scaled differently in each level.
+def ground_motion_record_id(gm_name):
+    if gm_name is None:
+        return None
+    parts = gm_name.replace("\\", "/").split("/")
+    stem = parts[-1].replace(".txt", "")
+    return "/".join(parts[-3:-2] + [stem])
+
+
+
+# Path of a record id under ground_motion_root, the layout of the processed records:
+# <ground_motion_root>/<level folder>/<EQ>/<EQ>_<direction>.txt
+def ground_motion_record_path(record_id, ground_motion_root):
+    level, stem = record_id.split("/")
+    return os.path.join(ground_motion_root, level, stem.rsplit("_", 1)[0], stem + ".txt")
+
+
+
+# Name of the orthogonal record of a ground motion pair (FN <-> FP).
+def orthogonal_ground_motion_name(gm_name):
+    direction = gm_name.split('_')[-1].replace('.txt', '')
+    if direction == 'FN':
+        orthogonal_direction = 'FP'
+    elif direction == 'FP':
+        orthogonal_direction = 'FN'
+    else:
+        raise ValueError("wrong ground motion direction")
+    return gm_name.replace(direction, orthogonal_direction)
+
+
+
+# Record ids of the X direction record of a ground motion name and of its orthogonal record.
+def ground_motion_pair_ids(gm_X_name):
+    if gm_X_name is None:
+        return None, None
+    return ground_motion_record_id(gm_X_name), ground_motion_record_id(orthogonal_ground_motion_name(gm_X_name))
+
+
+
+# The same few dozen records are shared by thousands of structures, so each record is only parsed once.
+_folded_ground_motions = {}
+
+def load_folded_ground_motion(path, record_id=None, max_steps=2000, batch=10):
+    key = (record_id, max_steps, batch)
+    if record_id is not None and key in _folded_ground_motions:
+        return _folded_ground_motions[key]
+
+    folded = fold_ground_motion(read_ground_motion(path), max_steps, batch)
+    folded.flags.writeable = False
+    if record_id is not None:
+        _folded_ground_motions[key] = folded
+    return folded
+
+
+
+# Ground motion pairs shared by the structures of a dataset, each pair is folded and stored once and
+# the graphs only keep gm_row, the row of their pair (keyed by the record id of the X direction record).
+# (gm_row, not gm_index: PyG's Batch shifts the attributes named like *index* by the node count.)
+# ground_motions: [pair_num, timesteps, 2 * batch], the X direction record followed by the orthogonal one.
+class GroundMotionBank(object):
+    def __init__(self, timesteps, max_steps=2000, batch=10, record_ids=None, ground_motions=None):
+        self.timesteps = timesteps
+        self.max_steps = max_steps
+        self.batch = batch
+        self.record_ids = [] if record_ids is None else list(record_ids)
+        self.index = {record_id: i for i, record_id in enumerate(self.record_ids)}
+        self.pairs = [] if ground_motions is None else list(ground_motions)
+        self._ground_motions = ground_motions
+
+
+    # record_id_1, record_id_2: ids of the two records, their folded records are cached by load_folded_ground_motion
+    # (and shared with the other banks of the process), a record without id is parsed again for every new pair.
+    def add(self, record_id, path_1, path_2, record_id_1=None, record_id_2=None):
+        if record_id in self.index:
+            return self.index[record_id]
+        ground_motion_1 = load_folded_ground_motion(path_1, record_id_1, self.max_steps, self.batch)[:self.timesteps]
+        ground_motion_2 = load_folded_ground_motion(path_2, record_id_2, self.max_steps, self.batch)[:self.timesteps]
+        self.index[record_id] = len(self.record_ids)
+        self.record_ids.append(record_id)
+        self.pairs.append(torch.from_numpy(np.concatenate([ground_motion_1, ground_motion_2], axis=1)))
+        self._ground_motions = None
+        return self.index[record_id]
+
+
+    @property
+    def ground_motions(self):
+        if self._ground_motions is None:
+            self._ground_motions = torch.stack(self.pairs) if len(self.pairs) > 0 else torch.zeros((0, self.timesteps, 2 * self.batch))
+            self.pairs = list(self._ground_motions)
+        return self._ground_motions
+
+
+    def __len__(self):
+        return len(self.record_ids)
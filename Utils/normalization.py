@@ -1,112 +1,212 @@
 import torch
-from torch_geometric.loader import DataLoader
-from copy import deepcopy
+from torch.utils.data import Dataset
+from torch_geometric.data import Data
+from copy import copy, deepcopy
 import random
+import json
+import os
+from os.path import join
+from .ground_motion import GroundMotionBank, orthogonal_ground_motion_name
+from .dataset import CACHE_VERSION, CACHE_STATISTICS, CompiledGroundMotionDataset
+
+
+# Streaming statistics of the dataset features, accumulated one graph at a time instead of collating
+# the whole dataset into one batch. Per channel of x [node, 35], y [node, timestep, 30] and the
+# ground motions [pair, timestep, direction] it keeps the max of |value|, the sum and the square sum
+# (for mean / std), and optionally a uniform sample of rows (reservoir) to estimate percentiles.
+class NormStatistics(object):
+    channel_nums = {'x': 35, 'y': 30, 'ground_motion': 2}
+
+    def __init__(self, percentiles=None, sample_size=100000, seed=731):
+        self.percentiles = list(percentiles) if percentiles else []
+        self.sample_size = sample_size
+        self.generator = torch.Generator().manual_seed(seed)
+        self.graph_num = 0
+        self.count = {name: 0 for name in self.channel_nums.keys()}
+        self.abs_max = {name: torch.zeros(num, dtype=torch.float64) for name, num in self.channel_nums.items()}
+        self.sum = {name: torch.zeros(num, dtype=torch.float64) for name, num in self.channel_nums.items()}
+        self.square_sum = {name: torch.zeros(num, dtype=torch.float64) for name, num in self.channel_nums.items()}
+        self.samples = {name: torch.zeros((0, num)) for name, num in self.channel_nums.items()}
+        self.sample_keys = {name: torch.zeros(0) for name in self.channel_nums.keys()}
+
+
+    def update(self, name, value):
+        value = value.reshape(-1, value.shape[-1])[:, :self.channel_nums[name]].float()
+        self.count[name] += value.shape[0]
+        self.abs_max[name] = torch.maximum(self.abs_max[name], torch.amax(torch.abs(value), dim=0).double())
+        self.sum[name] += torch.sum(value, dim=0, dtype=torch.float64)
+        self.square_sum[name] += torch.sum(torch.square(value), dim=0, dtype=torch.float64)
+
+        # keep the rows with the smallest random keys seen so far, a uniform sample of every row
+        if len(self.percentiles) > 0:
+            keys = torch.cat([self.sample_keys[name], torch.rand(value.shape[0], generator=self.generator)])
+            samples = torch.cat([self.samples[name], value.float()])
+            if keys.shape[0] > self.sample_size:
+                keys, kept = torch.topk(keys, self.sample_size, largest=False)
+                samples = samples[kept]
+            self.sample_keys[name], self.samples[name] = keys, samples
+
+
+    def update_graph(self, graph):
+        self.update('x', graph.x)
+        self.update('y', graph.y)
+        self.graph_num += 1
+
+
+    def update_ground_motions(self, ground_motions):
+        # [pair, timestep, 2 * batch] -> rows of (X direction, orthogonal direction) accelerations
+        pair_num, timesteps, columns = ground_motions.shape
+        self.update('ground_motion', ground_motions.reshape(pair_num, timesteps, 2, columns // 2).transpose(2, 3))
+
+
+    def group_max(self, name, columns):
+        return torch.max(self.abs_max[name][list(columns)]).item()
+
+
+    # The same min-max groups as the normalization (every min is 0).
+    def norm_dict(self):
+        norm_dict = dict()
+        norm_dict['ground_motion'] = [0, self.group_max('ground_motion', range(0, 2))]
+
+        # x
+        norm_dict['grid_num'] = [0, self.group_max('x', range(0, 3))]
+        norm_dict['coord'] = [0, self.group_max('x', range(3, 6))]
+        norm_dict['period'] = [0, self.group_max('x', range(11, 14))]
+        norm_dict['modal_shape'] = [0, self.group_max('x', range(14, 23))]
+        norm_dict['elem_length'] = [0, self.group_max('x', range(23, 35, 2))]
+
+        # y
+        norm_dict['acc'] = [0, self.group_max('y', range(0, 2))]
+        norm_dict['vel'] = [0, self.group_max('y', range(2, 4))]
+        norm_dict['disp'] = [0, self.group_max('y', range(4, 6))]
+        norm_dict['momentY'] = [0, self.group_max('y', range(6, 12))]
+        # Here normalize response momentZ with each section's My_z (yielding moment)
+        norm_dict['momentZ'] = [0, max(self.group_max('y', range(12, 18)), self.group_max('x', range(24, 35, 2)))]
+        norm_dict['shearY'] = [0, self.group_max('y', range(18, 24))]
+        norm_dict['shearZ'] = [0, self.group_max('y', range(24, 30))]
+        return norm_dict
+
+
+    # Per channel mean / std (and percentiles) of every feature.
+    def summary(self):
+        summary = dict()
+        for name in self.channel_nums.keys():
+            count = max(self.count[name], 1)
+            mean = self.sum[name] / count
+            std = torch.sqrt(torch.clamp(self.square_sum[name] / count - mean ** 2, min=0))
+            summary[name] = {'mean': mean.tolist(), 'std': std.tolist(), 'abs_max': self.abs_max[name].tolist()}
+            if len(self.percentiles) > 0 and self.samples[name].shape[0] > 0:
+                q = torch.tensor(self.percentiles, dtype=torch.float64) / 100
+                quantiles = torch.quantile(self.samples[name].double(), q, dim=0)
+                summary[name]["percentiles"] = {str(float(p)): quantiles[i].tolist() for i, p in enumerate(self.percentiles)}
+        return summary
+
+
+
+def compute_statistics(dataset, percentiles=None):
+    statistics = NormStatistics(percentiles)
+    for graph in dataset:
+        statistics.update_graph(graph)
+    # ground motion (every pair in the bank is used by some graph)
+    statistics.update_ground_motions(dataset.ground_motion_bank.ground_motions)
+    return statistics
+
+
+
+# A compiled dataset keeps its statistics next to the cache files (compile_dataset removes them),
+# so only the first run over a cache goes through the data.
+def load_statistics(dataset, percentiles=None):
+    cache_dir = getattr(dataset, "cache_dir", None)
+    if cache_dir is None or not os.path.exists(join(cache_dir, CACHE_STATISTICS)):
+        return None
+    with open(join(cache_dir, CACHE_STATISTICS), "r") as f:
+        saved = json.load(f)
+    if saved["version"] != CACHE_VERSION or saved["graph_num"] != len(dataset):
+        return None
+    if not set(str(float(p)) for p in (percentiles or [])) <= set(saved["percentiles"]):
+        return None
+    return saved
+
+
+def save_statistics(dataset, statistics):
+    cache_dir = getattr(dataset, "cache_dir", None)
+    if cache_dir is None:
+        return
+    saved = {"version": CACHE_VERSION, "graph_num": statistics.graph_num, "norm_dict": statistics.norm_dict(),
+             "percentiles": [str(float(p)) for p in statistics.percentiles], "statistics": statistics.summary()}
+    with open(join(cache_dir, CACHE_STATISTICS), "w") as f:
+        json.dump(saved, f)
+
+
+
+# percentiles: also estimate these per channel percentiles (saved with the statistics of a compiled dataset).
+def get_norm_dict(dataset, norm_dict, percentiles=None):
+    saved = load_statistics(dataset, percentiles)
+    if saved is None:
+        statistics = compute_statistics(dataset, percentiles)
+        save_statistics(dataset, statistics)
+        norm_dict.update(statistics.norm_dict())
+    else:
+        norm_dict.update(saved["norm_dict"])
+    return norm_dict
 
 
-def get_norm_dict(dataset, norm_dict):
-    loader = DataLoader(dataset, batch_size=len(dataset))
-    graph = next(iter(loader))
-    ground_motion_1, ground_motion_2, x, y, edge_attr = graph.ground_motion_1, graph.ground_motion_2, graph.x, graph.y, graph.edge_attr        
-
-    # ground motion
-    min_ground_motion = 0
-    max_ground_motion_1 = torch.max(torch.abs(ground_motion_1)).item()
-    max_ground_motion_2 = torch.max(torch.abs(ground_motion_2)).item()
-    max_ground_motion = max(max_ground_motion_1, max_ground_motion_2)
-    norm_dict['ground_motion'] = [min_ground_motion, max_ground_motion]
-
-    # x
-    min_grid_num = 0
-    max_grid_num = torch.max(torch.abs(x[:, :3])).item()
-    norm_dict['grid_num'] = [min_grid_num, max_grid_num]
-    
-    min_coord = 0
-    max_coord = torch.max(torch.abs(x[:, 3:6])).item()
-    norm_dict['coord'] = [min_coord, max_coord]
-
-    min_period = 0
-    max_period = torch.max(torch.abs(x[:, 11:14])).item()
-    norm_dict['period'] = [min_period, max_period]
-
-    min_modal_shape = 0
-    max_modal_shape = torch.max(torch.abs(x[:, 14:23])).item()
-    norm_dict['modal_shape'] = [min_modal_shape, max_modal_shape]
-
-    min_length = 0
-    max_length = torch.max(torch.abs(x[:, list(range(23, 35, 2))])).item()
-    norm_dict['elem_length'] = [min_length, max_length]
-
-
-    # y
-    min_acc = 0
-    max_acc = torch.max(torch.abs(y[:, :, 0:2])).item()
-    norm_dict['acc'] = [min_acc, max_acc]
-
-    min_vel = 0
-    max_vel = torch.max(torch.abs(y[:, :, 2:4])).item()
-    norm_dict['vel'] = [min_vel, max_vel]
-
-    min_disp = 0
-    max_disp = torch.max(torch.abs(y[:, :, 4:6])).item()
-    norm_dict['disp'] = [min_disp, max_disp]
-
-    min_momentY = 0
-    max_momentY = torch.max(torch.abs(y[:, :, 6:12])).item()
-    norm_dict['momentY'] = [min_momentY, max_momentY]
-    
-    # Here normalize response momentZ with each section's My_z (yielding moment)
-    min_momentZ = 0
-    max_momentZ = torch.max(torch.max(torch.abs(y[:, :, 12:18])), torch.max(torch.abs(x[:, list(range(24, 35, 2))]))).item()
-    norm_dict['momentZ'] = [min_momentZ, max_momentZ]
-
-    min_shearY = 0
-    max_shearY = torch.max(torch.abs(y[:, :, 18:24])).item()
-    norm_dict['shearY'] = [min_shearY, max_shearY]
-
-    min_shearZ = 0
-    max_shearZ = torch.max(torch.abs(y[:, :, 24:30])).item()
-    norm_dict['shearZ'] = [min_shearZ, max_shearZ]
-    
-    return norm_dict
 
+def normalize_ground_motion_bank(ground_motion_bank, norm_dict):
+    # (float32 also for a bank memory-mapped in reduced precision, it is only a few records)
+    ground_motions = (ground_motion_bank.ground_motions.float() - norm_dict['ground_motion'][0]) / (norm_dict['ground_motion'][1] - norm_dict['ground_motion'][0])
+    return GroundMotionBank(ground_motion_bank.timesteps, ground_motion_bank.max_steps, ground_motion_bank.batch,
+                            record_ids=ground_motion_bank.record_ids, ground_motions=ground_motions)
 
 
-def normalize(original_graph, norm_dict):
-    graph = deepcopy(original_graph)
-    graph.ground_motion_1 = (graph.ground_motion_1 - norm_dict['ground_motion'][0]) / (norm_dict['ground_motion'][1] - norm_dict['ground_motion'][0])
-    graph.ground_motion_2 = (graph.ground_motion_2 - norm_dict['ground_motion'][0]) / (norm_dict['ground_motion'][1] - norm_dict['ground_motion'][0])
 
-    graph.x[:, :3] = (graph.x[:, :3] - norm_dict['grid_num'][0]) / (norm_dict['grid_num'][1] - norm_dict['grid_num'][0])
-    graph.x[:, 3:6] = (graph.x[:, 3:6] - norm_dict['coord'][0]) / (norm_dict['coord'][1] - norm_dict['coord'][0])
-    graph.x[:, 11:14] = (graph.x[:, 11:14] - norm_dict['period'][0]) / (norm_dict['period'][1] - norm_dict['period'][0])
-    graph.x[:, 14:23] = (graph.x[:, 14:23] - norm_dict['modal_shape'][0]) / (norm_dict['modal_shape'][1] - norm_dict['modal_shape'][0])
-    graph.x[:, list(range(23, 35, 2))] = (graph.x[:, list(range(23, 35, 2))] - norm_dict['elem_length'][0]) / (norm_dict['elem_length'][1] - norm_dict['elem_length'][0])
-    graph.x[:, list(range(24, 35, 2))] = (graph.x[:, list(range(24, 35, 2))] - norm_dict['momentZ'][0]) / (norm_dict['momentZ'][1] - norm_dict['momentZ'][0])
+# Min-max scaling as one (offset, scale) vector per feature axis: normalized = (value - offset) / scale,
+# the features without a group in norm_dict keep offset 0, scale 1.
+class FeatureNormalizer(object):
+    x_groups = {'grid_num': range(0, 3), 'coord': range(3, 6), 'period': range(11, 14), 'modal_shape': range(14, 23),
+                'elem_length': range(23, 35, 2), 'momentZ': range(24, 35, 2)}
+    y_groups = {'acc': range(0, 2), 'vel': range(2, 4), 'disp': range(4, 6), 'momentY': range(6, 12),
+                'momentZ': range(12, 18), 'shearY': range(18, 24), 'shearZ': range(24, 30)}
+    edge_attr_groups = {'elem_length': [0], 'momentZ': [3]}
 
-    graph.y[:, :, 0:2] = (graph.y[:, :, 0:2] - norm_dict['acc'][0]) / (norm_dict['acc'][1] - norm_dict['acc'][0])
-    graph.y[:, :, 2:4] = (graph.y[:, :, 2:4] - norm_dict['vel'][0]) / (norm_dict['vel'][1] - norm_dict['vel'][0])
-    graph.y[:, :, 4:6] = (graph.y[:, :, 4:6] - norm_dict['disp'][0]) / (norm_dict['disp'][1] - norm_dict['disp'][0])
-    graph.y[:, :, 6:12] = (graph.y[:, :, 6:12] - norm_dict['momentY'][0]) / (norm_dict['momentY'][1] - norm_dict['momentY'][0])
-    graph.y[:, :, 12:18] = (graph.y[:, :, 12:18] - norm_dict['momentZ'][0]) / (norm_dict['momentZ'][1] - norm_dict['momentZ'][0])
-    graph.y[:, :, 18:24] = (graph.y[:, :, 18:24] - norm_dict['shearY'][0]) / (norm_dict['shearY'][1] - norm_dict['shearY'][0])
-    graph.y[:, :, 24:30] = (graph.y[:, :, 24:30] - norm_dict['shearZ'][0]) / (norm_dict['shearZ'][1] - norm_dict['shearZ'][0])
+    def __init__(self, norm_dict):
+        self.norm_dict = norm_dict
+        self.vectors = {}
 
-    graph.edge_attr[:, 0] = (graph.edge_attr[:, 0] - norm_dict['elem_length'][0]) / (norm_dict['elem_length'][1] - norm_dict['elem_length'][0])
-    graph.edge_attr[:, 3] = (graph.edge_attr[:, 3] - norm_dict['momentZ'][0]) / (norm_dict['momentZ'][1] - norm_dict['momentZ'][0])
 
-    gm_X_direction = graph.gm_X_name.split('_')[-1].replace('.txt', '')
-    if gm_X_direction == 'FN':
-        gm_Z_direction = 'FP'
-    elif gm_X_direction == 'FP':
-        gm_Z_direction = 'FN'
-    else:
-        raise ValueError("wrong ground motion direction")
-    graph.gm_Z_name = graph.gm_X_name.replace(gm_X_direction, gm_Z_direction)
+    def get_vectors(self, name, dim):
+        if (name, dim) not in self.vectors:
+            offset, scale = torch.zeros(dim), torch.ones(dim)
+            for key, columns in getattr(self, f"{name}_groups").items():
+                columns = [column for column in columns if column < dim]
+                offset[columns] = self.norm_dict[key][0]
+                scale[columns] = self.norm_dict[key][1] - self.norm_dict[key][0]
+            self.vectors[(name, dim)] = (offset, scale)
+        return self.vectors[(name, dim)]
+
+
+    def __call__(self, value, name, inplace=False):
+        offset, scale = self.get_vectors(name, value.shape[-1])
+        offset, scale = offset.to(value.device), scale.to(value.device)
+        if inplace:
+            return value.sub_(offset).div_(scale)
+        return (value - offset) / scale
 
-    graph.x = graph.x[:, 0:35]
-    graph.ground_motions = torch.cat([graph.ground_motion_1, graph.ground_motion_2], dim=1)
-    graph.ground_motions = graph.ground_motions.unsqueeze(0)
+
+
+# ground_motion_bank is the normalized bank, graph.ground_motions is a view of the graph's row in it.
+# With inplace=True the features of original_graph are overwritten instead of copied.
+def normalize(original_graph, normalizer, ground_motion_bank, inplace=False):
+    graph = original_graph if inplace else copy(original_graph)
+
+    graph.x = normalizer(graph.x[:, 0:35], 'x', inplace)
+    graph.y = normalizer(graph.y, 'y', inplace)
+    graph.edge_attr = normalizer(graph.edge_attr, 'edge_attr', inplace)
+
+    graph.gm_Z_name = orthogonal_ground_motion_name(graph.gm_X_name)
+
+    gm_row = graph.gm_row.item()
+    graph.ground_motions = ground_motion_bank.ground_motions[gm_row : gm_row + 1]
     timesteps = graph.ground_motions.shape[1]
     graph.y = graph.y[:, :timesteps, :]
     assert graph.x.shape[1] == 35
@@ -117,7 +217,8 @@ def normalize(original_graph, norm_dict):
 
 
 def structureSampling(normed_graph, norm_dict, random_sample):
-    graph = deepcopy(normed_graph)
+    # only sampled_node_index is set below, so a shallow copy is enough (and keeps ground_motions a view of the bank)
+    graph = copy(normed_graph)
 
     # if random sample
     if random_sample:
@@ -128,7 +229,7 @@ def structureSampling(normed_graph, norm_dict, random_sample):
         random.shuffle(indexes)
         sampled_indexes = indexes[:sampled_num]
         sampled_indexes.sort()
-        graph.sampled_index = tuple(sampled_indexes)
+        graph.sampled_node_index = torch.tensor(sampled_indexes, dtype=torch.long)
         return graph
 
     # if not random sample
@@ -171,26 +272,63 @@ def structureSampling(normed_graph, norm_dict, random_sample):
     sampled_node_index = [index for i, index in enumerate(sampled_node_index) if i%2==0]
 
     # Now we don't sample the node here. We first save the info about which node shoud be sampled later.
-    # sampled_index = torch.zeros(graph.x.shape[0])
-    # for index in sampled_node_index:
-    #     sampled_index[index] = 1
-    # graph.sampled_index = sampled_index
-
-    graph.sampled_index = tuple(sampled_node_index)
+    # (an "index" attribute, so the DataLoader offsets it by the first node of the graph in the batch)
+    graph.sampled_node_index = torch.tensor(sampled_node_index, dtype=torch.long)
 
     return graph
 
 
 
 
+# Normalize each graph when it is fetched, for datasets too large to keep a normalized copy in memory.
+# The sampled nodes are still drawn once here, so every epoch sees the same sampled_node_index,
+# from the node grid coordinates only (a compiled dataset reads them without touching y).
+class NormalizedDataset(Dataset):
+    def __init__(self, dataset, norm_dict, random_sample=False):
+        self.dataset = dataset
+        self.norm_dict = norm_dict
+        self.normalizer = FeatureNormalizer(norm_dict)
+        self.ground_motion_bank = normalize_ground_motion_bank(dataset.ground_motion_bank, norm_dict)
+        self.paths = []
+        self.sampled_indexes = []
+        for i in range(len(dataset)):
+            if isinstance(dataset, CompiledGroundMotionDataset):
+                x, grid_num, path = dataset.topology(i)
+            else:
+                graph = dataset[i]
+                x, grid_num, path = graph.x[:, :6], graph.grid_num, graph.path
+            topology = Data(x=normalize_x(x, norm_dict), grid_num=grid_num)
+            self.sampled_indexes.append(structureSampling(topology, norm_dict, random_sample).sampled_node_index)
+            self.paths.append(path)
+
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def __getitem__(self, i):
+        # not in place, the fetched graph may be a view of the dataset (or of its memory-mapped files)
+        graph = normalize(self.dataset[i], self.normalizer, self.ground_motion_bank)
+        graph.sampled_node_index = self.sampled_indexes[i]
+        return graph
+
+
+
+
 # Normalize the whole dataset.
-def normalize_dataset(dataset, random_sample=False):
+# inplace=True overwrites the graphs of the dataset, so setup never holds a second copy of them.
+def normalize_dataset(dataset, random_sample=False, lazy=False, inplace=False, percentiles=None):
     norm_dict = dict()
-    norm_dict = get_norm_dict(dataset, norm_dict)
+    norm_dict = get_norm_dict(dataset, norm_dict, percentiles)
+    if lazy:
+        return NormalizedDataset(dataset, norm_dict, random_sample), norm_dict
+
     normed_dataset = []
+    normalizer = FeatureNormalizer(norm_dict)
+    ground_motion_bank = normalize_ground_motion_bank(dataset.ground_motion_bank, norm_dict)
 
     for graph in dataset:
-        graph_norm = normalize(graph, norm_dict)
+        graph_norm = normalize(graph, normalizer, ground_motion_bank, inplace)
         graph_norm = structureSampling(graph_norm, norm_dict, random_sample)
         normed_dataset.append(graph_norm)
 
@@ -223,6 +361,12 @@ def normalize_coord(coord, norm_dict):
     norm_coord = (coord - norm_dict['coord'][0]) / (norm_dict['coord'][1] - norm_dict['coord'][0])
     return norm_coord
 
+def normalize_x(x, norm_dict):
+    norm_x = deepcopy(x)
+    norm_x[:, :3] = (norm_x[:, :3] - norm_dict['grid_num'][0]) / (norm_dict['grid_num'][1] - norm_dict['grid_num'][0])
+    norm_x[:, 3:6] = (norm_x[:, 3:6] - norm_dict['coord'][0]) / (norm_dict['coord'][1] - norm_dict['coord'][0])
+    return norm_x
+
 
 
 
@@ -291,4 +435,10 @@ def denormalize_shearZ(norm_shearZ, norm_dict):
     shearZ = shearZ * (norm_dict['shearZ'][1] - norm_dict['shearZ'][0]) + norm_dict['shearZ'][0]
     return shearZ
 
-
+def denormalize_y(norm_y, norm_dict, y_start=0, output_index=None):
+    # every response channel of a prediction [..., output_dim] at once, y_start: channel of y of the first output
+    # (output_index: the output channels of a selective prediction [..., len(output_index)])
+    channels = y_start + (torch.arange(norm_y.shape[-1]) if output_index is None else output_index.cpu())
+    offset, scale = FeatureNormalizer(norm_dict).get_vectors('y', int(channels.max()) + 1)
+    offset, scale = offset[channels].to(norm_y.device), scale[channels].to(norm_y.device)
+    return norm_y * scale + offset
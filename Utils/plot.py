@@ -7,6 +7,7 @@ from torch_geometric.loader import DataLoader
 import os
 from .normalization import *
 from .accuracy import *
+from .utils import get_channel_index
 
 
 def print_space():
@@ -118,21 +119,17 @@ def plot_test_accuracy_distribution(test_dataset, model, neglect_beam_My_Sz, ckp
     R2_per_structure = []
     device = "cuda"
     model.eval()
+    channel_index = get_channel_index(test_dataset[0].y.shape[-1], neglect_beam_My_Sz, device)
     for i in range(len(test_dataset)):
         graph = test_dataset[i].clone().to(device)
         graph.ptr = torch.tensor([0, graph.x.shape[0]]).to(device)
-        graph.sampled_index = [graph.sampled_index]
         graph.batch = torch.zeros(graph.x.shape[0]).to(device).to(torch.int64) 
 
-        output, keeped_indexes = model(graph.x, graph.edge_index, graph.edge_attr, graph.batch, graph.ptr, graph.sampled_index, graph.ground_motions, sample_node=False)
+        output, keeped_indexes = model(graph.x, graph.edge_index, graph.edge_attr, graph.batch, graph.ptr, graph.sampled_node_index, graph.ground_motions, sample_node=False)
         x, y = graph.x[keeped_indexes], graph.y[keeped_indexes]
 
-        mask = torch.ones(y.shape, dtype=bool)
-        if neglect_beam_My_Sz:
-            mask[:, :, (6,7,10,11)] = False    # neglect beam's MomentY
-            mask[:, :, (24,25,28,29)] = False  # neglect beam's ShearZ
-        mask_y = y[mask].reshape(y.shape[0], y.shape[1], -1)
-        mask_output = output[mask].reshape(output.shape[0], output.shape[1], -1)
+        mask_y = y.index_select(-1, channel_index)
+        mask_output = output.index_select(-1, channel_index)
 
         R2_acc = R2_score(mask_output, mask_y).cpu().numpy()
         R2_per_structure.append(float(R2_acc))
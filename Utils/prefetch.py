@@ -0,0 +1,98 @@
+import torch
+import threading
+import queue
+import time
+
+
+_END = object()
+
+
+# Iterate a DataLoader with the next batches collated in a background thread (at most prefetch batches
+# ahead, in a bounded queue) while the current one trains; with a CUDA device they are also pinned and
+# copied on a side stream. stall_time is the time the last iteration spent waiting for its batches,
+# prefetch=0 iterates synchronously (and still measures the stall time, for comparison).
+class PrefetchLoader(object):
+    def __init__(self, loader, device="cpu", prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.stall_time = 0.0
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        if self.prefetch <= 0:
+            return self.iterate()
+        return self.iterate_prefetched()
+
+
+    def iterate(self):
+        iterator = iter(self.loader)
+        while True:
+            start_time = time.perf_counter()
+            batch = next(iterator, _END)
+            if batch is not _END:
+                batch = batch.to(self.device)
+            self.stall_time += time.perf_counter() - start_time
+            if batch is _END:
+                return
+            yield batch
+
+
+    def iterate_prefetched(self):
+        # the iterator is created here, so the sampler's random state is drawn by the training thread
+        batches = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(iter(self.loader), batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.perf_counter()
+                item = batches.get()
+                self.stall_time += time.perf_counter() - start_time
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    # wait for the copy, and keep its memory from being reused by the side stream while in use
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    batch.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+    def produce(self, iterator, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in iterator:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = batch.pin_memory().to(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                if not self.put(batches, (batch, event), stop):
+                    return
+            self.put(batches, _END, stop)
+        except Exception as e:
+            self.put(batches, e, stop)
+
+
+    def put(self, batches, item, stop):
+        # (gives up when the training loop stopped iterating early)
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
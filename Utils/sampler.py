@@ -0,0 +1,90 @@
+import torch
+from torch.utils.data import Sampler, Subset
+from .dataset import CompiledGroundMotionDataset
+from .normalization import NormalizedDataset
+
+
+# Size of every graph of a dataset without collating it: "node" counts all the nodes (GNN, y of the batch),
+# "sampled" only the sampled nodes (node decoder). Compiled and lazily normalized datasets answer from
+# their index, so no graph is read from disk.
+def graph_sizes(dataset, count="node"):
+    if isinstance(dataset, Subset):
+        sizes = graph_sizes(dataset.dataset, count)
+        return [sizes[i] for i in dataset.indices]
+    if count == "sampled" and isinstance(dataset, NormalizedDataset):
+        return [len(sampled_index) for sampled_index in dataset.sampled_indexes]
+    if count == "node" and isinstance(dataset, NormalizedDataset):
+        return graph_sizes(dataset.dataset, count)
+    if count == "node" and isinstance(dataset, CompiledGroundMotionDataset):
+        return [info["node_num"] for info in dataset.graph_infos]
+    if count == "sampled":
+        return [graph.sampled_node_index.numel() for graph in dataset]
+    return [graph.num_nodes for graph in dataset]
+
+
+
+# Batches packed to a node budget instead of a fixed number of graphs, for torch_geometric's
+# DataLoader(dataset, batch_sampler=...). Each epoch the graphs are shuffled, split into buckets of
+# bucket_batches * (graphs per budget) graphs, sorted by size inside a bucket and packed in order until the next
+# graph would exceed node_budget (a graph larger than the budget is a batch by itself), so the graphs of
+# a batch have similar sizes; then the batches are shuffled. With num_replicas > 1 (distributed training)
+# every rank takes every num_replicas-th batch, padded so all ranks run the same number of steps.
+class NodeBudgetBatchSampler(Sampler):
+    def __init__(self, sizes, node_budget, shuffle=True, bucket_batches=50, seed=731, num_replicas=1, rank=0):
+        self.sizes = torch.tensor(sizes)
+        self.node_budget = node_budget
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        graphs_per_batch = max(1, node_budget // max(1, int(self.sizes.float().mean().item()))) if len(sizes) > 0 else 1
+        self.bucket_size = bucket_batches * graphs_per_batch
+        self.set_epoch(0)
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self.create_batches()
+
+
+    def pack(self, indexes):
+        batches, batch, batch_nodes = [], [], 0
+        for i in indexes:
+            size = self.sizes[i].item()
+            if len(batch) > 0 and batch_nodes + size > self.node_budget:
+                batches.append(batch)
+                batch, batch_nodes = [], 0
+            batch.append(i)
+            batch_nodes += size
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+
+    def create_batches(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indexes = torch.randperm(len(self.sizes), generator=generator)
+        else:
+            indexes = torch.arange(len(self.sizes))
+
+        batches = []
+        for bucket in indexes.split(self.bucket_size):
+            order = torch.argsort(self.sizes[bucket], stable=True)
+            batches += self.pack(bucket[order].tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        if self.num_replicas > 1:
+            padded_num = -(-len(batches) // self.num_replicas) * self.num_replicas
+            batches = (batches * (-(-padded_num // len(batches))))[:padded_num] if len(batches) > 0 else batches
+            batches = batches[self.rank :: self.num_replicas]
+        return batches
+
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+    def __len__(self):
+        return len(self.batches)
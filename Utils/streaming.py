@@ -0,0 +1,58 @@
+import torch
+from .normalization import denormalize_y
+
+
+# Incremental prediction of one structure for real-time monitoring: the ground motion samples are pushed
+# as they arrive, folded into frames of frame_samples samples per direction (one model timestep, like
+# fold_ground_motion), and each complete frame advances the graph LSTM and the node decoder from their
+# state after the previous frames (GraphLSTM.forward_window), so a push only costs its new frames.
+#   stream = StreamingPredictor(model, x, edge_index, edge_attr, norm_dict)
+#   responses = stream.push(samples)    # samples: [sample_num, 2] (X, Z); responses: [node_num, new frames, output_dim]
+class StreamingPredictor(object):
+    def __init__(self, model, x, edge_index, edge_attr, norm_dict, node_index=None, frame_samples=10, y_start=0, output_index=None):
+        # x, edge_index, edge_attr: the normalized structure graph, node_index: the nodes to predict (all if None)
+        # output_index: the output channels to predict (all if None, see utils.get_output_index)
+        self.model = model.eval()
+        self.norm_dict = norm_dict
+        self.frame_samples = frame_samples
+        self.y_start = y_start
+        self.output_index = output_index
+        batch = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        with torch.no_grad():
+            self.latent, self.node, _, self.node_graph_index = model.encode(x, edge_index, edge_attr, batch, node_index,
+                                                                            sample_node=node_index is not None)
+        self.reset()
+
+
+    def reset(self):
+        # start of a new ground motion
+        self.state = None
+        self.samples = self.node.new_zeros((0, 2))
+        self.frame_num = 0
+
+
+    @torch.no_grad()
+    def push(self, samples):
+        # samples: [sample_num, 2] new acceleration samples of the X and Z direction records (in the unit of
+        # the record files), the samples of an incomplete frame are kept until the next push
+        samples = torch.cat([self.samples, torch.as_tensor(samples, dtype=self.samples.dtype, device=self.samples.device)])
+        frame_num = samples.shape[0] // self.frame_samples
+        self.samples = samples[frame_num * self.frame_samples :]
+
+        # [frame_num, 2 * frame_samples]: the X samples of the frame followed by the Z samples
+        frames = samples[: frame_num * self.frame_samples].view(frame_num, self.frame_samples, 2).permute(0, 2, 1).reshape(frame_num, 2 * self.frame_samples)
+        ground_motion_min, ground_motion_max = self.norm_dict['ground_motion']
+        return self.push_frames((frames - ground_motion_min) / (ground_motion_max - ground_motion_min))
+
+
+    @torch.no_grad()
+    def push_frames(self, frames):
+        # frames: [frame_num, ground_motion_dim] normalized folded frames, returns the denormalized responses
+        # of the predicted nodes at these frames: [node_num, frame_num, output_dim]
+        if frames.shape[0] == 0:
+            output_dim = self.model.nodeTimeSeriesDecoder.output_dim if self.output_index is None else self.output_index.shape[0]
+            return self.node.new_zeros((self.node.shape[0], 0, output_dim))
+        output, self.state = self.model.forward_window(self.latent, self.node, self.node_graph_index, frames.unsqueeze(0),
+                                                       self.state, self.output_index)
+        self.frame_num += frames.shape[0]
+        return denormalize_y(output, self.norm_dict, self.y_start, self.output_index)
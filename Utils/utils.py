@@ -37,6 +37,43 @@ def get_target_index(target, neglect_beam_My_Sz=False):
     return y_start, y_finish, target_dict     
 
 
+# Selective-output inference: the nodes and the response channels to predict.
+# Channels of y of each response (see FeatureNormalizer.y_groups).
+RESPONSE_CHANNELS = {'acc': range(0, 2), 'vel': range(2, 4), 'disp': range(4, 6), 'My': range(6, 12),
+                     'Mz': range(12, 18), 'Sy': range(18, 24), 'Sz': range(24, 30)}
+
+
+def get_output_index(responses, y_start=0, output_dim=30, device="cpu"):
+    # output channels of the model (output = y[..., y_start : y_start + output_dim]) of the given responses, e.g. ["disp", "Mz"]
+    output_index = [channel - y_start for response in responses for channel in RESPONSE_CHANNELS[response]
+                    if 0 <= channel - y_start < output_dim]
+    if len(output_index) == 0:
+        raise ValueError(f"the model doesn't predict any of {responses}")
+    return torch.tensor(output_index, dtype=torch.long, device=device)
+
+
+def select_nodes(x, norm_dict, story=None, x_grid=None, z_grid=None, if_bottom=None, if_top=None, if_side=None):
+    # indexes of the nodes of a normalized structure graph that match every given selector:
+    # story, x_grid, z_grid: grid coordinates (an int or a list) of the node (story 0 is the base, 1 the 1F floor),
+    # if_bottom, if_top (roof), if_side: the 0 / 1 flags of x
+    grid = denormalize_x(x[:, :6], norm_dict)[:, 3:6].round().long()
+    mask = torch.ones(x.shape[0], dtype=torch.bool, device=x.device)
+    for column, values in ((0, x_grid), (1, story), (2, z_grid)):
+        if values is not None:
+            mask &= torch.isin(grid[:, column], torch.tensor(values, device=x.device).reshape(-1))
+    for column, value in ((6, if_bottom), (7, if_top), (8, if_side)):
+        if value is not None:
+            mask &= (x[:, column] == value)
+    return mask.nonzero().view(-1)
+
+
+# output channels used by the loss and the overall accuracy, selected with index_select(-1, ...)
+# (beam's MomentY (6,7,10,11) and ShearZ (24,25,28,29) are neglected with neglect_beam_My_Sz)
+def get_channel_index(output_dim, neglect_beam_My_Sz=False, device="cpu"):
+    neglected = (6, 7, 10, 11, 24, 25, 28, 29) if neglect_beam_My_Sz else ()
+    return torch.tensor([i for i in range(output_dim) if i not in neglected], dtype=torch.long, device=device)
+
+
 # prepare a dictionary to record target accuracy
 def get_target_accuracy(args, target_dict):
     target_accuracy_record = dict()
@@ -34,12 +34,11 @@ def visualize_response(model, ckpt_dir, dataset, dataset_name, norm_dict, accura
     # batch = next(iter(loader))
     batch = g.clone().to(device)
     batch.ptr = torch.tensor([0, batch.x.shape[0]]).to(device)
-    batch.sampled_index = [batch.sampled_index]
     batch.batch = torch.zeros(batch.x.shape[0]).to(device).to(torch.int64)
     model.eval()
 
     with torch.no_grad():
-        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_index, batch.ground_motions, sample_node=False)
+        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False)
         x, y = batch.x[keeped_indexes], batch.y[keeped_indexes]
     
     if response == "Acceleration_X":
@@ -270,12 +269,11 @@ def visualize_response(model, ckpt_dir, dataset, dataset_name, norm_dict, accura
     # batch = next(iter(loader))
     batch = g.clone().to(device)
     batch.ptr = torch.tensor([0, batch.x.shape[0]]).to(device)
-    batch.sampled_index = [batch.sampled_index]
     batch.batch = torch.zeros(batch.x.shape[0]).to(device).to(torch.int64)
     model.eval()
 
     with torch.no_grad():
-        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_index, batch.ground_motions, sample_node=False)
+        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False)
         x, y = batch.x[keeped_indexes], batch.y[keeped_indexes]
     
     if response == "Displacement_X":
@@ -437,7 +435,7 @@ def visualize_plasticHinge(model, ckpt_dir, dataset, dataset_name, norm_dict, cl
     model.eval()
 
     with torch.no_grad():
-        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_index, batch.ground_motions, sample_node=False)
+        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False)
         x, y = batch.x[keeped_indexes], batch.y[keeped_indexes]
 
     # Plot
@@ -544,7 +542,6 @@ def visualize_graph_attention(model, ckpt_dir, dataset, dataset_name, norm_dict,
     batch = next(iter(loader))
     batch = g.clone().to(device)
     batch.ptr = torch.tensor([0, batch.x.shape[0]]).to(device)
-    batch.sampled_index = [batch.sampled_index]
     batch.batch = torch.zeros(batch.x.shape[0]).to(device).to(torch.int64)
     model.eval()
 
@@ -2,6 +2,9 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import eqsig.single
+import sys
+sys.path.append("../")
+from Utils.ground_motion import read_ground_motion
 from pathlib import Path
 
 
@@ -19,8 +22,7 @@ for i, gm_file in enumerate(os.listdir(gm_folder)[:10]):
     print("ploting:", gm_path)
 
     # find the scale factor
-    file = np.loadtxt(gm_path)
-    gm = file[:, 1] / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
+    gm = read_ground_motion(gm_path) / 1000 / 9.8    # Here divide by 1000 and 9.8 is to plot the curve in terms of g
     # record_FN = eqsig.AccSignal(gm, dt)
     # record_FN.generate_response_spectrum(response_times=periods)
 
@@ -2,6 +2,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import eqsig.single
+import sys
+sys.path.append("../")
+from Utils.ground_motion import read_ground_motion
 from tqdm import tqdm
 
 
@@ -55,10 +58,8 @@ for i, gm_folder in enumerate(tqdm(os.listdir(root_1))):
     gm_FN_path = os.path.join(root_1, gm_folder, gm_name + "_FN.txt")
     gm_FP_path = os.path.join(root_1, gm_folder, gm_name + "_FP.txt")
     print(i, gm_FN_path, gm_FP_path)
-    file_FN = np.loadtxt(gm_FN_path)
-    file_FP = np.loadtxt(gm_FP_path)
-    gm_FN = file_FN[:, 1] / 1000 / 9.8
-    gm_FP = file_FP[:, 1] / 1000 / 9.8
+    gm_FN = read_ground_motion(gm_FN_path) / 1000 / 9.8
+    gm_FP = read_ground_motion(gm_FP_path) / 1000 / 9.8
     record_FN = eqsig.AccSignal(gm_FN, dt)
     record_FP = eqsig.AccSignal(gm_FP, dt)
     record_FN.generate_response_spectrum(response_times=periods)
@@ -83,10 +84,8 @@ for i, gm_folder in enumerate(tqdm(os.listdir(root_2))):
     gm_FN_path = os.path.join(root_2, gm_folder, gm_name + "_FN.txt")
     gm_FP_path = os.path.join(root_2, gm_folder, gm_name + "_FP.txt")
     print(i, gm_FN_path, gm_FP_path)
-    file_FN = np.loadtxt(gm_FN_path)
-    file_FP = np.loadtxt(gm_FP_path)
-    gm_FN = file_FN[:, 1] / 1000 / 9.8
-    gm_FP = file_FP[:, 1] / 1000 / 9.8
+    gm_FN = read_ground_motion(gm_FN_path) / 1000 / 9.8
+    gm_FP = read_ground_motion(gm_FP_path) / 1000 / 9.8
     record_FN = eqsig.AccSignal(gm_FN, dt)
     record_FP = eqsig.AccSignal(gm_FP, dt)
     record_FN.generate_response_spectrum(response_times=periods)
@@ -0,0 +1,378 @@
+import torch
+from torch_geometric.data import Data
+from torch_geometric.loader import DataLoader
+from torch.profiler import profile, ProfilerActivity
+import time
+import os
+import tempfile
+from argparse import ArgumentParser, Namespace
+import sys
+sys.path.append("../")
+
+
+from Models.LSTM import *
+from Models import inference
+from Utils import sampler
+from Utils import prefetch
+from Utils import streaming
+from Utils import utils
+from Utils.ground_motion import fold_ground_motion
+
+
+
+
+# Benchmarks of the model on random structures (no dataset needed), run from this folder:
+#   python benchmark.py --timesteps 1400 --threads 8
+BENCHMARKS = {
+    "node_decoder": "cell vs fused decoder",
+    "inference": "eager vs TorchScript",
+    "tbptt": "train step memory of truncated BPTT windows",
+    "checkpoint": "train step memory of checkpointed decoder blocks",
+    "bf16": "float32 vs bfloat16 autocast",
+    "batch_sampler": "batches of structure_num graphs vs node budget batches of graphs with 0.25 ~ 2.5 x node_num nodes",
+    "prefetch": "training epoch stall time without vs with background prefetching",
+    "ground_motion_sweep": "one structure under sweep_ground_motions ground motions, collated batch vs encoding fan out vs ground motion batch",
+    "streaming": "latency of pushing stream_frames frames at a time to a StreamingPredictor",
+    "selective_output": "every node and response vs a few nodes and responses",
+}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+
+    # synthetic batch
+    parser.add_argument("--structure_num", type=int, default=12, help="structures in the batch")
+    parser.add_argument("--node_num", type=int, default=100, help="nodes per structure")
+    parser.add_argument("--sample_ratio", type=float, default=0.1, help="ratio of nodes decoded per structure")
+    parser.add_argument("--timesteps", type=int, default=300)
+
+    # model
+    parser.add_argument("--gnn_num_layers", type=int, default=1)
+    parser.add_argument("--head_num", type=int, default=4)
+    parser.add_argument("--gnn_hidden_dim", type=int, default=64)
+    parser.add_argument("--latent_dim", type=int, default=128)
+    parser.add_argument("--graph_lstm_hidden_dim", type=int, default=128)
+    parser.add_argument("--graph_lstm_num_layers", type=int, default=1)
+    parser.add_argument("--node_lstm_hidden_dim", type=int, default=256)
+    parser.add_argument("--node_lstm_num_layers", type=int, default=2)
+
+    # benchmark
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=["node_decoder", "inference"], choices=list(BENCHMARKS.keys()),
+                        help=", ".join(f"{name}: {description}" for name, description in BENCHMARKS.items()))
+    parser.add_argument("--tbptt_windows", type=int, nargs="+", default=[0, 100, 25], help="windows of the tbptt benchmark, 0: whole sequence")
+    parser.add_argument("--checkpoint_blocks", type=int, nargs="+", default=[0, 100, 50, 25], help="checkpoint_timesteps of the checkpoint benchmark, 0: off")
+    parser.add_argument("--sweep_ground_motions", type=int, default=16, help="ground motions of the one structure of the ground_motion_sweep benchmark")
+    parser.add_argument("--stream_frames", type=int, default=1, help="frames (of 10 samples per direction) per push of the streaming benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each case, the fastest one is reported")
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--random_seed", type=int, default=731)
+
+    args = parser.parse_args()
+    return args
+
+
+
+def synthetic_batch(structure_num, node_num, sample_ratio, timesteps, node_dim=35, edge_dim=4, ground_motion_dim=20):
+    graphs = synthetic_graphs(structure_num, node_num, sample_ratio, timesteps, node_dim, edge_dim, ground_motion_dim)
+    return collate(graphs)
+
+
+def collate(graphs):
+    return next(iter(DataLoader(graphs, batch_size=len(graphs))))
+
+
+def synthetic_graphs(structure_num, node_num, sample_ratio, timesteps, node_dim=35, edge_dim=4, ground_motion_dim=20):
+    graphs = []
+    for _ in range(structure_num):
+        # a chain of nodes with both edge directions, like the frame graphs
+        source = torch.arange(node_num - 1)
+        edge_index = torch.cat([torch.stack([source, source + 1]), torch.stack([source + 1, source])], dim=1)
+        sampled_index = torch.randperm(node_num)[:max(1, int(node_num * sample_ratio))].sort().values
+        graphs.append(Data(x=torch.rand(node_num, node_dim), edge_index=edge_index,
+                           edge_attr=torch.rand(edge_index.shape[1], edge_dim),
+                           ground_motions=torch.randn(1, timesteps, ground_motion_dim) * 0.1,
+                           sampled_node_index=sampled_index))
+    return graphs
+
+
+
+def build_model(args, node_decoder="cell"):
+    return GraphLSTM(node_dim=35, edge_dim=4, gnn_num_layers=args.gnn_num_layers, head_num=args.head_num,
+                     gnn_hidden_dim=args.gnn_hidden_dim, latent_dim=args.latent_dim,
+                     graph_lstm_hidden_dim=args.graph_lstm_hidden_dim, graph_lstm_num_layers=args.graph_lstm_num_layers,
+                     node_lstm_hidden_dim=args.node_lstm_hidden_dim, node_lstm_num_layers=args.node_lstm_num_layers,
+                     ground_motion_dim=20, output_dim=30, device="cpu", node_decoder=node_decoder)
+
+
+
+def run_model(model, batch, backward=False):
+    output, _ = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions)
+    if backward:
+        output.square().mean().backward()
+    return output
+
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+
+# Peak of the CPU memory allocated by torch during fn (allocations and frees of the profiler in time order,
+# each counted once in the op that made it, memory freed inside the same op is not seen).
+def peak_memory(fn):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted([event for event in prof.events() if event.self_cpu_memory_usage != 0], key=lambda event: event.time_range.start)
+    allocated, peak = 0, 0
+    for event in events:
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+
+
+# One training step (forward, backward) with truncated backpropagation through time, like train.py --tbptt_window.
+def run_tbptt(model, batch, window):
+    if window <= 0:
+        return run_model(model, batch, backward=True)
+    latent, node, _, node_graph_index = model.encode(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.sampled_node_index)
+    latent_leaf = latent.detach().requires_grad_()
+    timesteps = batch.ground_motions.shape[1]
+    state = None
+    for start in range(0, timesteps, window):
+        end = min(start + window, timesteps)
+        output, state = model.forward_window(latent_leaf, node, node_graph_index, batch.ground_motions[:, start:end], state)
+        (output.square().mean() * ((end - start) / timesteps)).backward()
+        state = state.detach()
+    latent.backward(latent_leaf.grad)
+
+
+def benchmark_tbptt(args, batch):
+    for node_decoder in ["cell", "fused"]:
+        model = build_model(args, node_decoder)
+        model.train()
+        for window in args.tbptt_windows:
+            memory = peak_memory(lambda: run_tbptt(model, batch, window))
+            step_time = timeit(lambda: run_tbptt(model, batch, window), args.repeat)
+            print(f"{node_decoder:>6s} node decoder, tbptt window {window if window > 0 else args.timesteps:5d}: "
+                  f"train step {step_time:.3f} s, peak memory {memory / 2**20:.1f} MiB")
+
+
+
+def benchmark_checkpoint(args, batch):
+    for node_decoder in ["cell", "fused"]:
+        model = build_model(args, node_decoder)
+        model.train()
+        for block in args.checkpoint_blocks:
+            model.nodeTimeSeriesDecoder.checkpoint_timesteps = block
+            memory = peak_memory(lambda: run_model(model, batch, backward=True))
+            step_time = timeit(lambda: run_model(model, batch, backward=True), args.repeat)
+            print(f"{node_decoder:>6s} node decoder, checkpoint block {block if block > 0 else args.timesteps:5d}: "
+                  f"train step {step_time:.3f} s, peak memory {memory / 2**20:.1f} MiB")
+
+
+
+def benchmark_bf16(args, batch):
+    for node_decoder in ["cell", "fused"]:
+        model = build_model(args, node_decoder)
+        times = {}
+        for dtype in [torch.float32, torch.bfloat16]:
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=dtype == torch.bfloat16):
+                model.train()
+                train_time = timeit(lambda: run_model(model, batch, backward=True), args.repeat)
+                model.eval()
+                with torch.no_grad():
+                    inference_time = timeit(lambda: run_model(model, batch), args.repeat)
+            print(f"{node_decoder:>6s} node decoder, {str(dtype).replace('torch.', ''):>8s}: train step {train_time:.3f} s, inference {inference_time:.3f} s")
+
+
+
+# Step time and size of the batches over one epoch of graphs whose node numbers vary by 10x,
+# batch_size = structure_num graphs vs NodeBudgetBatchSampler with the same mean nodes per batch.
+def benchmark_batch_sampler(args):
+    generator = torch.Generator().manual_seed(args.random_seed)
+    node_nums = torch.randint(args.node_num // 4, args.node_num * 5 // 2 + 1, (args.structure_num * 8,), generator=generator).tolist()
+    graphs = [graph for node_num in node_nums for graph in synthetic_graphs(1, node_num, args.sample_ratio, args.timesteps)]
+    node_budget = sum(node_nums) // 8
+    model = build_model(args, "cell")
+    model.train()
+
+    loaders = {"batch_size": DataLoader(graphs, batch_size=args.structure_num, shuffle=True),
+               "node_budget": DataLoader(graphs, batch_sampler=sampler.NodeBudgetBatchSampler(sampler.graph_sizes(graphs), node_budget,
+                                                                                             bucket_batches=4, seed=args.random_seed))}
+    for name, loader in loaders.items():
+        node_nums, step_times = [], []
+        for batch in loader:
+            node_nums.append(batch.num_nodes)
+            step_times.append(timeit(lambda: run_model(model, batch, backward=True), 1))
+        node_nums, step_times = torch.tensor(node_nums).float(), torch.tensor(step_times)
+        print(f"{name:>11s}: {len(loader)} batches, nodes per batch {node_nums.min():.0f} ~ {node_nums.max():.0f} (std {node_nums.std():.0f}), "
+              f"step time {step_times.min():.3f} ~ {step_times.max():.3f} s (std {step_times.std():.3f}), epoch {step_times.sum():.2f} s")
+
+
+
+def benchmark_prefetch(args):
+    graphs = synthetic_graphs(args.structure_num * 8, args.node_num, args.sample_ratio, args.timesteps)
+    model = build_model(args, "cell")
+    model.train()
+
+    # same batches in the same order (the sampler's random state is drawn by the training thread)
+    for depth in [0, 2]:
+        torch.manual_seed(args.random_seed)
+        loader = prefetch.PrefetchLoader(DataLoader(graphs, batch_size=args.structure_num, shuffle=True), "cpu", depth)
+        start_time = time.perf_counter()
+        for batch in loader:
+            run_model(model, batch, backward=True)
+        epoch_time = time.perf_counter() - start_time
+        print(f"prefetch {depth}: {len(loader)} batches, epoch {epoch_time:.2f} s, stall {loader.stall_time:.3f} s")
+
+
+
+def benchmark_node_decoder(args, batch):
+    node_num = batch.ptr[-1].item()
+    decoded_node_num = batch.sampled_node_index.numel()
+    for node_decoder in ["cell", "fused"]:
+        model = build_model(args, node_decoder)
+        model.train()
+        train_time = timeit(lambda: run_model(model, batch, backward=True), args.repeat)
+        model.eval()
+        with torch.no_grad():
+            inference_time = timeit(lambda: run_model(model, batch), args.repeat)
+        print(f"{node_decoder:>6s} node decoder: train step {train_time:.3f} s, inference {inference_time:.3f} s, "
+              f"{decoded_node_num * args.timesteps / inference_time:.0f} node-steps/s ({node_num} nodes, {decoded_node_num} decoded)")
+
+
+
+# Latency of one structure through the eager model (no_grad, every node) and the exported TorchScript module.
+def benchmark_inference(args):
+    model = build_model(args, "cell")
+    model.eval()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model_Best_inference.pt")
+        inference.export_inference_model(model, path)
+        scripted_model = inference.load_inference_model(path)
+
+    batch = synthetic_batch(1, args.node_num, 1.0, args.timesteps)
+    inputs = (batch.x, batch.edge_index, batch.edge_attr, batch.batch)
+    with torch.no_grad():
+        scripted_model(*inputs, batch.ground_motions)  # warm up the TorchScript profiling executor
+        eager_time = timeit(lambda: model(*inputs, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False), args.repeat)
+        scripted_time = timeit(lambda: scripted_model(*inputs, batch.ground_motions), args.repeat)
+    print(f"inference latency ({args.node_num} nodes, {args.timesteps} timesteps): eager {eager_time:.3f} s, "
+          f"TorchScript {scripted_time:.3f} s ({eager_time / scripted_time:.2f}x)")
+
+
+def sweep_batch(graph, ground_motions):
+    # the collated batch of the structure once per ground motion (what the DataLoader would build)
+    graphs = [Data(x=graph.x, edge_index=graph.edge_index, edge_attr=graph.edge_attr, ground_motions=ground_motions[i : i + 1],
+                   sampled_node_index=graph.sampled_node_index) for i in range(ground_motions.shape[0])]
+    return collate(graphs)
+
+
+def benchmark_ground_motion_sweep(args):
+    model = build_model(args, "cell")
+    model.eval()
+    graph = synthetic_graphs(1, args.node_num, 1.0, args.timesteps)[0]
+    ground_motions = torch.randn(args.sweep_ground_motions, args.timesteps, 20) * 0.1
+    batch = sweep_batch(graph, ground_motions)
+    structure = (graph.x, graph.edge_index, graph.edge_attr)
+
+    def collated():
+        output, _ = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False)
+        return output.view(args.sweep_ground_motions, args.node_num, args.timesteps, -1)
+
+    cache = inference.StructureEncodingCache(model)
+    cases = {"collated": collated,
+             "ground motion batched": lambda: model.forward_ground_motions(*structure, ground_motions),
+             "cached encoding": lambda: inference.predict_ground_motions(model, *structure, ground_motions, cache)}
+    with torch.no_grad():
+        print(f"ground motion sweep (1 structure x {args.sweep_ground_motions} ground motions, {args.node_num} nodes, {args.timesteps} timesteps):")
+        for name, fn in cases.items():
+            print(f"{name:>21s}: {timeit(fn, args.repeat):.3f} s, peak memory {peak_memory(fn) / 2 ** 20:.1f} MiB")
+        encode_time = timeit(lambda: inference.encode_structure(model, *structure), args.repeat)
+    print(f"structure encoding {encode_time * 1000:.1f} ms, cache hits {cache.hits} / misses {cache.misses}")
+
+
+def benchmark_streaming(args):
+    model = build_model(args, "cell")
+    model.eval()
+    graph = synthetic_graphs(1, args.node_num, 1.0, args.timesteps)[0]
+    structure = (graph.x, graph.edge_index, graph.edge_attr)
+    norm_dict = {key: [0.0, 1.0] for key in ["acc", "vel", "disp", "momentY", "momentZ", "shearY", "shearZ", "ground_motion"]}
+    records = torch.randn(args.timesteps * 10, 2) * 0.1
+    ground_motions = torch.cat([torch.from_numpy(fold_ground_motion(records[:, i].numpy(), args.timesteps)) for i in range(2)], dim=1)
+
+    with torch.no_grad():
+        stream = streaming.StreamingPredictor(model, *structure, norm_dict)
+        latencies = []
+        for start in range(0, records.shape[0], args.stream_frames * 10):
+            latencies.append(timeit(lambda: stream.push(records[start : start + args.stream_frames * 10]), 1))
+        full_time = timeit(lambda: model(*structure, torch.zeros(args.node_num, dtype=torch.long), None, None, ground_motions.unsqueeze(0), sample_node=False), 1)
+    latencies = torch.tensor(latencies) * 1000
+    print(f"streaming ({args.node_num} nodes, {args.stream_frames} frames per push): latency per push mean {latencies.mean():.2f} ms, "
+          f"max {latencies.max():.2f} ms, total {latencies.sum() / 1000:.3f} s (whole sequence at once {full_time:.3f} s)")
+
+
+def benchmark_selective_output(args):
+    model = build_model(args, "cell")
+    model.eval()
+    graph = synthetic_graphs(1, args.node_num, 1.0, args.timesteps)[0]
+    structure = (graph.x, graph.edge_index, graph.edge_attr)
+    ground_motions = torch.randn(args.sweep_ground_motions, args.timesteps, 20) * 0.1
+    # e.g. the displacement of every 10th node (a roof line)
+    node_index = torch.arange(0, args.node_num, 10)
+    output_index = utils.get_output_index(["disp"])
+
+    with torch.no_grad():
+        all_time = timeit(lambda: model.forward_ground_motions(*structure, ground_motions), args.repeat)
+        selective_time = timeit(lambda: model.forward_ground_motions(*structure, ground_motions, node_index, output_index), args.repeat)
+    print(f"selective output ({args.sweep_ground_motions} ground motions, {args.timesteps} timesteps): "
+          f"{args.node_num} nodes x {model.nodeTimeSeriesDecoder.output_dim} channels {all_time:.3f} s, "
+          f"{node_index.shape[0]} nodes x {output_index.shape[0]} channels {selective_time:.3f} s ({all_time / selective_time:.2f}x)")
+
+
+
+
+def main(args):
+    torch.manual_seed(args.random_seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads")
+
+    if "node_decoder" in args.benchmarks:
+        batch = synthetic_batch(args.structure_num, args.node_num, args.sample_ratio, args.timesteps)
+        benchmark_node_decoder(args, batch)
+    if "inference" in args.benchmarks:
+        benchmark_inference(args)
+    if "tbptt" in args.benchmarks:
+        batch = synthetic_batch(args.structure_num, args.node_num, args.sample_ratio, args.timesteps)
+        benchmark_tbptt(args, batch)
+    if "checkpoint" in args.benchmarks:
+        batch = synthetic_batch(args.structure_num, args.node_num, args.sample_ratio, args.timesteps)
+        benchmark_checkpoint(args, batch)
+    if "bf16" in args.benchmarks:
+        batch = synthetic_batch(args.structure_num, args.node_num, args.sample_ratio, args.timesteps)
+        benchmark_bf16(args, batch)
+    if "batch_sampler" in args.benchmarks:
+        benchmark_batch_sampler(args)
+    if "prefetch" in args.benchmarks:
+        benchmark_prefetch(args)
+    if "ground_motion_sweep" in args.benchmarks:
+        benchmark_ground_motion_sweep(args)
+    if "streaming" in args.benchmarks:
+        benchmark_streaming(args)
+    if "selective_output" in args.benchmarks:
+        benchmark_selective_output(args)
+
+
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
@@ -0,0 +1,238 @@
+import torch
+from torch_geometric.data import Data, Batch
+import numpy as np
+import time
+import os
+import json
+from os.path import join, basename, normpath
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from tqdm import tqdm
+import sys
+sys.path.append("../")
+
+
+from Models.LSTM import *
+from Models import inference
+from Utils import dataset
+from Utils import normalization
+from Utils import utils
+from Utils.ground_motion import load_folded_ground_motion
+
+
+# Batched inference of a trained GraphLSTM on new structures without ground truth, e.g.
+#   python predict.py --result_dir ../Results/<dataset>/<date> --structures <folder> ... --ground_motions gm_FN.txt,gm_FP.txt ...
+# predicts every structure under every ground motion pair (or its own pair, without --ground_motions) and writes
+# the denormalized responses of each structure to <output_dir>/<index>_<folder>.npy: [pair_num, node_num, timesteps, output_dim],
+# with predictions.json listing the files, the ground motion pairs, the nodes and the output channels.
+# --responses and the node selectors (--story, --if_top, ...) limit the prediction to those channels and nodes.
+
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+
+    # trained model (folder of training_args.json, norm_dict.json and Models/model_Best.pt)
+    parser.add_argument("--result_dir", type=Path, required=True)
+    parser.add_argument("--model_name", type=str, default="model_Best.pt")
+
+    # structures and ground motions
+    parser.add_argument("--structures", type=str, nargs="+", required=True, help="structure folders, or .txt files listing one folder per line")
+    parser.add_argument("--ground_motions", type=str, nargs="*", default=[], help="ground motion pairs 'X.txt,Z.txt', every structure is predicted under each of them (default: the structure's own pair)")
+    parser.add_argument("--whatAsNode", type=str, default=None, help="graph type of the structure folders (default: the training one)")
+    parser.add_argument("--timesteps", type=int, default=0, help="predicted timesteps (0: the training timesteps)")
+
+    # selective output (all the nodes and responses by default), only the selected nodes are decoded
+    parser.add_argument("--responses", type=str, nargs="+", default=None, choices=list(utils.RESPONSE_CHANNELS.keys()), help="responses to predict")
+    parser.add_argument("--story", type=int, nargs="+", default=None, help="nodes on these stories (0: base)")
+    parser.add_argument("--x_grid", type=int, nargs="+", default=None, help="nodes on these X grid lines")
+    parser.add_argument("--z_grid", type=int, nargs="+", default=None, help="nodes on these Z grid lines")
+    parser.add_argument("--if_bottom", type=int, default=None, choices=[0, 1])
+    parser.add_argument("--if_top", type=int, default=None, choices=[0, 1], help="1: roof nodes")
+    parser.add_argument("--if_side", type=int, default=None, choices=[0, 1])
+
+    # inference
+    parser.add_argument("--output_dir", type=Path, default=Path("./Predictions"))
+    parser.add_argument("--output_dtype", type=str, default="float32", choices=["float32", "float16"])
+    parser.add_argument("--batch_size", type=int, default=16, help="(structure, ground motion) pairs per batch")
+    parser.add_argument("--encoding_cache", type=int, default=64, help="structures whose encoding is kept (LRU) when sweeping --ground_motions")
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--device", type=str, default="cpu")
+
+    args = parser.parse_args()
+    return args
+
+
+
+def structure_folders(structures):
+    folders = []
+    for structure in structures:
+        if structure.endswith(".txt"):
+            with open(structure, "r") as f:
+                folders += [line.strip() for line in f if line.strip() != ""]
+        else:
+            folders.append(structure)
+    return folders
+
+
+
+def load_model(result_dir, model_name, node_dim, edge_dim, ground_motion_dim, device):
+    with open(result_dir / "training_args.json", "r") as f:
+        training_args = Namespace(**json.load(f))
+    with open(result_dir / "norm_dict.json", "r") as f:
+        norm_dict = json.load(f)
+
+    y_start, y_finish, target_dict = utils.get_target_index(training_args.target)
+    model_constructor_args = {
+        'node_dim': node_dim, 'edge_dim': edge_dim, 'gnn_num_layers': training_args.gnn_num_layers, 'gnn_hidden_dim': training_args.gnn_hidden_dim,
+        'head_num': training_args.head_num, 'latent_dim': training_args.latent_dim, 'graph_lstm_hidden_dim': training_args.graph_lstm_hidden_dim,
+        'graph_lstm_num_layers': training_args.graph_lstm_num_layers, 'node_lstm_hidden_dim': training_args.node_lstm_hidden_dim,
+        'node_lstm_num_layers': training_args.node_lstm_num_layers, 'ground_motion_dim': ground_motion_dim,
+        'output_dim': y_finish - y_start, 'device': device, 'node_decoder': getattr(training_args, "node_decoder", "cell")}
+    model = globals()[training_args.model](**model_constructor_args).to(device)
+    model.load_state_dict(torch.load(result_dir / "Models" / model_name, map_location=device))
+    model.eval()
+    return model, training_args, norm_dict, y_start, target_dict
+
+
+
+def normalized_structure(folder, graph_type, normalizer):
+    graph = torch.load(join(folder, f"structure_graph_{graph_type}.pt"))
+    return Data(x=normalizer(graph.x[:, 0:35].float(), 'x'), edge_index=graph.edge_index,
+                edge_attr=normalizer(graph.edge_attr.float(), 'edge_attr'))
+
+
+
+def normalized_ground_motions(path_X, path_Z, timesteps, norm_dict):
+    # [1, timesteps, 20]: the folded X direction record followed by the orthogonal one (like GroundMotionBank)
+    ground_motion_X = load_folded_ground_motion(path_X, path_X)[:timesteps]
+    ground_motion_Z = load_folded_ground_motion(path_Z, path_Z)[:timesteps]
+    ground_motions = torch.from_numpy(np.concatenate([ground_motion_X, ground_motion_Z], axis=1)).unsqueeze(0)
+    return (ground_motions - norm_dict['ground_motion'][0]) / (norm_dict['ground_motion'][1] - norm_dict['ground_motion'][0])
+
+
+
+@torch.no_grad()
+def predict(model, graphs, norm_dict, y_start, batch_size, device, output_index=None):
+    # graphs: iterable of normalized structure graphs with ground_motions and sampled_node_index (the nodes to predict)
+    # of any structure, yields the denormalized response of each of them in order, batch_size graphs per forward
+    batch = []
+    for graph in graphs:
+        batch.append(graph)
+        if len(batch) == batch_size:
+            yield from predict_batch(model, batch, norm_dict, y_start, device, output_index)
+            batch = []
+    if len(batch) > 0:
+        yield from predict_batch(model, batch, norm_dict, y_start, device, output_index)
+
+
+def predict_batch(model, graphs, norm_dict, y_start, device, output_index=None):
+    batch = Batch.from_data_list(graphs).to(device)
+    output, _ = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions,
+                      output_index=output_index)
+    output = normalization.denormalize_y(output, norm_dict, y_start, output_index).cpu()
+    yield from output.split([graph.sampled_node_index.shape[0] for graph in graphs])
+
+
+
+@torch.no_grad()
+def predict_sweep(model, structures, ground_motions, norm_dict, y_start, batch_size, cache, output_index=None):
+    # every structure under all the ground_motions [pair_num, timesteps, 20]: the structure is encoded once
+    # (or taken from the cache) and fanned out over batch_size ground motions at a time
+    for structure in structures:
+        for start in range(0, ground_motions.shape[0], batch_size):
+            output = inference.predict_ground_motions(model, structure.x, structure.edge_index, structure.edge_attr,
+                                                      ground_motions[start : start + batch_size], cache,
+                                                      node_index=structure.sampled_node_index, output_index=output_index)
+            yield from normalization.denormalize_y(output, norm_dict, y_start, output_index).cpu()
+
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    folders = structure_folders(args.structures)
+    ground_motion_pairs = [pair.split(",") for pair in args.ground_motions]
+    for pair in ground_motion_pairs:
+        assert len(pair) == 2, f"ground motion pair should be 'X.txt,Z.txt', got {pair}"
+
+    # (node_dim, edge_dim of the structure graphs, the ground motions are 2 directions folded by 10 samples)
+    with open(args.result_dir / "training_args.json", "r") as f:
+        graph_type = args.whatAsNode or json.load(f)["whatAsNode"]
+    first_graph = torch.load(join(folders[0], f"structure_graph_{graph_type}.pt"))
+    model, training_args, norm_dict, y_start, target_dict = load_model(args.result_dir, args.model_name, 35, first_graph.edge_attr.shape[1], 20, args.device)
+    normalizer = normalization.FeatureNormalizer(norm_dict)
+    timesteps = args.timesteps if args.timesteps > 0 else training_args.timesteps
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads, {len(folders)} structures, "
+          f"{len(ground_motion_pairs) if ground_motion_pairs else 'own'} ground motion pairs, {timesteps} timesteps")
+
+    # selective output: the output channels of the responses, and the selected nodes of each structure
+    output_dim = model.nodeTimeSeriesDecoder.output_dim
+    output_index = None
+    if args.responses is not None:
+        output_index = utils.get_output_index(args.responses, y_start, output_dim, args.device)
+        output_dim = output_index.shape[0]
+    selectors = {name: getattr(args, name) for name in ["story", "x_grid", "z_grid", "if_bottom", "if_top", "if_side"]
+                 if getattr(args, name) is not None}
+
+    # the structures of the sweep with their ground motion pairs, in order
+    structures = []
+    def sweep_structures():
+        for index, folder in enumerate(folders):
+            structure = normalized_structure(folder, graph_type, normalizer)
+            structure.sampled_node_index = utils.select_nodes(structure.x, norm_dict, **selectors) if selectors else torch.arange(structure.num_nodes)
+            if structure.sampled_node_index.numel() == 0:
+                raise ValueError(f"{folder}: no node matches the selection {selectors}")
+            pairs = ground_motion_pairs if ground_motion_pairs else [dataset.ground_motion_paths(folder)]
+            structures.append((index, folder, structure.sampled_node_index.tolist(), pairs))
+            yield structure.to(args.device)
+
+    # (structure, ground motion pair) graphs of the whole sweep, batched across structures
+    def sweep_graphs():
+        for structure in sweep_structures():
+            path_X, path_Z = structures[-1][3][0]
+            structure.ground_motions = normalized_ground_motions(path_X, path_Z, timesteps, norm_dict)
+            yield structure
+
+    if ground_motion_pairs:
+        # the same pairs for every structure: normalized once, and each structure is encoded once for all of them
+        ground_motions = torch.cat([normalized_ground_motions(path_X, path_Z, timesteps, norm_dict)
+                                    for path_X, path_Z in ground_motion_pairs]).to(args.device)
+        cache = inference.StructureEncodingCache(model, args.encoding_cache)
+        outputs = predict_sweep(model, sweep_structures(), ground_motions, norm_dict, y_start, args.batch_size, cache, output_index)
+    else:
+        outputs = predict(model, sweep_graphs(), norm_dict, y_start, args.batch_size, args.device, output_index)
+
+    # the responses of a structure are written in place to its memory-mapped .npy file, so a sweep never holds them all
+    # (y_channels: the channel of y, see "channels", of each output channel)
+    y_channels = (y_start + (torch.arange(output_dim) if output_index is None else output_index.cpu())).tolist()
+    predictions = {"timesteps": timesteps, "dtype": args.output_dtype, "channels": target_dict, "y_start": y_start,
+                   "y_channels": y_channels, "structures": []}
+    responses, written = None, 0
+    start_time = time.time()
+    for output in tqdm(outputs):
+        if responses is None:
+            index, folder, node_index, pairs = structures[len(predictions["structures"])]
+            file_name = f"{index:05d}_{basename(normpath(folder))}.npy"
+            responses = np.lib.format.open_memmap(args.output_dir / file_name, mode="w+", dtype=args.output_dtype,
+                                                  shape=(len(pairs), len(node_index), timesteps, output_dim))
+        responses[written] = output.numpy()
+        written += 1
+        if written == responses.shape[0]:
+            responses.flush()
+            responses, written = None, 0
+            predictions["structures"].append({"folder": folder, "file": file_name, "node_index": node_index,
+                                              "ground_motions": [list(pair) for pair in pairs]})
+
+    with open(args.output_dir / "predictions.json", "w") as f:
+        json.dump(predictions, f, indent=2)
+    print(f"Predicted {len(predictions['structures'])} structures in {time.time() - start_time:.2f} s, saved to {args.output_dir}")
+
+
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
@@ -0,0 +1,14 @@
+import torch
+import random
+import sys
+import pytest
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+
+# every test starts from the same random state, so the synthetic graphs and the model weights are fixed
+@pytest.fixture(autouse=True)
+def random_seed():
+    random.seed(731)
+    torch.manual_seed(731)
@@ -0,0 +1,69 @@
+import torch
+from torch_geometric.data import Data
+from torch_geometric.loader import DataLoader
+import pytest
+pytest.importorskip("torch_scatter")
+
+
+from Models.LSTM import GraphLSTM
+
+
+# Tiny random structures and model for the model tests (like benchmark.py, without a dataset).
+NODE_NUM = 12
+TIMESTEPS = 15
+
+
+def synthetic_graphs(structure_num=3, node_num=NODE_NUM, sample_ratio=0.5, timesteps=TIMESTEPS, node_dim=35, edge_dim=4, ground_motion_dim=20):
+    graphs = []
+    for _ in range(structure_num):
+        # a chain of nodes with both edge directions, like the frame graphs
+        source = torch.arange(node_num - 1)
+        edge_index = torch.cat([torch.stack([source, source + 1]), torch.stack([source + 1, source])], dim=1)
+        sampled_index = torch.randperm(node_num)[:max(1, int(node_num * sample_ratio))].sort().values
+        graphs.append(Data(x=torch.rand(node_num, node_dim), edge_index=edge_index,
+                           edge_attr=torch.rand(edge_index.shape[1], edge_dim),
+                           ground_motions=torch.randn(1, timesteps, ground_motion_dim) * 0.1,
+                           sampled_node_index=sampled_index))
+    return graphs
+
+
+def collate(graphs):
+    return next(iter(DataLoader(graphs, batch_size=len(graphs))))
+
+
+# (node_lstm_hidden_dim > ground_motion_dim: the upper decoder layers take H without its last ground_motion_dim features)
+def build_model(node_decoder="cell"):
+    return GraphLSTM(node_dim=35, edge_dim=4, gnn_num_layers=1, head_num=2, gnn_hidden_dim=8, latent_dim=16,
+                     graph_lstm_hidden_dim=32, graph_lstm_num_layers=1, node_lstm_hidden_dim=32, node_lstm_num_layers=2,
+                     ground_motion_dim=20, output_dim=30, device="cpu", node_decoder=node_decoder)
+
+
+def run_model(model, batch, backward=False):
+    output, _ = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions)
+    if backward:
+        output.square().mean().backward()
+    return output
+
+
+# One training step (forward, backward) with truncated backpropagation through time, like train.py --tbptt_window.
+def run_tbptt(model, batch, window):
+    latent, node, _, node_graph_index = model.encode(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.sampled_node_index)
+    latent_leaf = latent.detach().requires_grad_()
+    timesteps = batch.ground_motions.shape[1]
+    state = None
+    for start in range(0, timesteps, window):
+        end = min(start + window, timesteps)
+        output, state = model.forward_window(latent_leaf, node, node_graph_index, batch.ground_motions[:, start:end], state)
+        (output.square().mean() * ((end - start) / timesteps)).backward()
+        state = state.detach()
+    latent.backward(latent_leaf.grad)
+
+
+def gradients(model):
+    return {name: param.grad.clone() for name, param in model.named_parameters()}
+
+
+def assert_gradients_close(grads, other_grads, atol):
+    assert grads.keys() == other_grads.keys()
+    for name in grads.keys():
+        assert torch.allclose(grads[name], other_grads[name], atol=atol), name
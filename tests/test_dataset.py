@@ -0,0 +1,141 @@
+import torch
+from torch_geometric.data import Data, Batch
+import numpy as np
+import os
+import pytest
+import random
+from os.path import join
+
+
+from Utils import dataset
+from Utils import normalization
+
+
+TIMESTEPS = 20
+
+
+
+# A structure folder like generate_structural_graph writes it: the graph has no gm_Z_name
+# (the generator only reads the first GroundAccel, Data drops the None attribute).
+def write_structure(folder, node_num=6, edge_num=10, moment_scale=1.0):
+    os.makedirs(folder)
+    for name in ["ground_motion_1.txt", "ground_motion_2.txt"]:
+        record = np.stack([np.arange(TIMESTEPS * 10) * 0.005, np.random.randn(TIMESTEPS * 10)], axis=1)
+        np.savetxt(join(folder, name), record)
+    y = torch.randn(node_num, TIMESTEPS, 30)
+    y[:, :, 6:18] *= moment_scale  # My, Mz
+    graph = Data(x=torch.rand(node_num, 35), y=y,
+                 edge_index=torch.randint(0, node_num, (2, edge_num)), edge_attr=torch.rand(edge_num, 4),
+                 grid_num=torch.tensor([1, 2, 1]), path=folder,
+                 gm_X_name="E:/Data/GroundMotions_World_processed_BSE-2\\EQ786\\EQ786_FN.txt", gm_Z_name=None)
+    assert "gm_Z_name" not in graph
+    torch.save(graph, join(folder, "structure_graph_NodeAsNode.pt"))
+
+
+@pytest.fixture
+def data_root(tmp_path, monkeypatch):
+    # compile_dataset reads ../Data/<folder> like the training scripts
+    for i in range(3):
+        write_structure(str(tmp_path / "Data" / "Synthetic" / f"structure_{i}"))
+    (tmp_path / "run").mkdir()
+    monkeypatch.chdir(tmp_path / "run")
+    # the graphs are pickled Data objects (torch.load without weights_only, like the training scripts)
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    return tmp_path
+
+
+def compile_synthetic(cache_dir, data_num=3, timesteps=TIMESTEPS):
+    dataset.compile_dataset(str(cache_dir), folder="Synthetic", data_num=data_num, timesteps=timesteps)
+    return dataset.cache_parameters("Synthetic", "NodeAsNode", data_num, timesteps, [], "float32")
+
+
+
+def test_compile_graph_without_gm_Z_name(data_root):
+    cache_dir = data_root / "cache"
+    parameters = compile_synthetic(cache_dir)
+    dset = dataset.CompiledGroundMotionDataset(str(cache_dir), parameters=parameters)
+
+    assert len(dset) == 3
+    for graph in dset:
+        assert graph.gm_Z_name == "E:/Data/GroundMotions_World_processed_BSE-2\\EQ786\\EQ786_FP.txt"
+        assert graph.y.shape[1] == TIMESTEPS
+        original = torch.load(join(graph.path, "structure_graph_NodeAsNode.pt"))
+        assert torch.equal(graph.x, original.x)
+        assert torch.equal(graph.edge_index, original.edge_index)
+
+
+@pytest.mark.parametrize("name, value", [("timesteps", TIMESTEPS // 2), ("data_num", 2), ("graph_type", "ElemAsNode"),
+                                         ("folder", "Other"), ("other_folders", ["Other"]), ("storage_dtype", "bfloat16")])
+def test_cache_parameters_mismatch(data_root, name, value):
+    cache_dir = data_root / "cache"
+    parameters = compile_synthetic(cache_dir)
+    dataset.CompiledGroundMotionDataset(str(cache_dir), parameters=parameters)
+
+    with pytest.raises(ValueError, match=name):
+        dataset.CompiledGroundMotionDataset(str(cache_dir), parameters={**parameters, name: value})
+
+
+def test_compile_first_timesteps(data_root):
+    cache_dir = data_root / "cache"
+    parameters = compile_synthetic(cache_dir, timesteps=TIMESTEPS // 2)
+    dset = dataset.CompiledGroundMotionDataset(str(cache_dir), parameters=parameters)
+
+    for graph in dset:
+        original = torch.load(join(graph.path, "structure_graph_NodeAsNode.pt"))
+        assert graph.y.shape[1] == TIMESTEPS // 2
+        assert torch.equal(graph.y[:, :, 2:], original.y[:, :TIMESTEPS // 2, 2:])
+        assert dset.ground_motion_bank.ground_motions.shape[1] == TIMESTEPS // 2
+
+
+def test_batch_keeps_bank_rows(data_root):
+    cache_dir = data_root / "cache"
+    parameters = compile_synthetic(cache_dir)
+    dset = dataset.CompiledGroundMotionDataset(str(cache_dir), parameters=parameters)
+
+    batch = Batch.from_data_list([dset[i] for i in range(len(dset))])
+    assert batch.gm_row.tolist() == [dset[i].gm_row.item() for i in range(len(dset))]
+
+
+def test_compile_realistic_moments(data_root):
+    # moments in kN-mm reach ~5e5 (e.g. My_z = 1563 * 350), beyond the float16 maximum of 65504
+    folder = str(data_root / "Data" / "Moments" / "structure_0")
+    write_structure(folder, moment_scale=5.47e5)
+    original = torch.load(join(folder, "structure_graph_NodeAsNode.pt"))
+    assert original.y.abs().max() > 65504
+
+    with pytest.raises(ValueError, match="float16"):
+        dataset.compile_dataset(str(data_root / "cache_float16"), folder="Moments", data_num=1, timesteps=TIMESTEPS, storage_dtype="float16")
+
+    dataset.compile_dataset(str(data_root / "cache"), folder="Moments", data_num=1, timesteps=TIMESTEPS, storage_dtype="bfloat16")
+    graph = dataset.CompiledGroundMotionDataset(str(data_root / "cache"))[0]
+    assert torch.isfinite(graph.y).all()
+    assert torch.allclose(graph.y[:, :, 2:], original.y[:, :, 2:], rtol=1e-2, atol=1e-2)
+
+
+def test_compile_refuses_values_that_are_not_finite(data_root):
+    folder = str(data_root / "Data" / "Infinite" / "structure_0")
+    write_structure(folder, moment_scale=float("inf"))
+
+    with pytest.raises(ValueError, match="not finite"):
+        dataset.compile_dataset(str(data_root / "cache"), folder="Infinite", data_num=1, timesteps=TIMESTEPS)
+
+
+def test_lazy_normalization_reads_no_graph(data_root, monkeypatch):
+    cache_dir = data_root / "cache"
+    compile_synthetic(cache_dir)
+    dset = dataset.CompiledGroundMotionDataset(str(cache_dir), mmap=True)
+    random.seed(731)
+    eager_dataset, norm_dict = normalization.normalize_dataset(dset, random_sample=True)
+
+    # the sampled nodes are drawn from the cache index and x only, like the eager normalization draws them
+    def read_graph(self, i):
+        raise AssertionError("NormalizedDataset read a whole graph")
+    with monkeypatch.context() as m:
+        m.setattr(dataset.CompiledGroundMotionDataset, "__getitem__", read_graph)
+        random.seed(731)
+        lazy_dataset = normalization.NormalizedDataset(dset, norm_dict, random_sample=True)
+
+    assert lazy_dataset.paths == dset.paths
+    for eager_graph, sampled_index, i in zip(eager_dataset, lazy_dataset.sampled_indexes, range(len(dset))):
+        assert torch.equal(eager_graph.sampled_node_index, sampled_index)
+        assert torch.equal(eager_graph.y, lazy_dataset[i].y.float())
@@ -0,0 +1,65 @@
+import torch
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+import os
+import socket
+
+
+from synthetic import TIMESTEPS, synthetic_graphs, collate, build_model, run_model, run_tbptt, gradients, assert_gradients_close
+from Utils import distributed
+
+
+WORLD_SIZE = 2
+ATOL = 1e-5
+
+
+
+# Data parallel training on one host: every process (gloo) trains on its share of the structures, the averaged
+# gradients must equal the gradients of one process on all of them (every structure has the same sampled node number,
+# so the mean loss of the whole batch is the mean of the shares' losses). Checked for DistributedDataParallel and for
+# truncated BPTT windows, which average the gradients with distributed.all_reduce_gradients.
+def distributed_worker(rank, graphs, state_dict, port, result_path):
+    os.environ.update({"RANK": str(rank), "WORLD_SIZE": str(WORLD_SIZE), "MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port)})
+    torch.set_num_threads(1)
+    distributed.init_distributed("gloo")
+    share = len(graphs) // WORLD_SIZE
+    batch = collate(graphs[rank * share : (rank + 1) * share])
+
+    grads = {}
+    for mode in ["ddp", "tbptt"]:
+        model = build_model("cell")
+        model.load_state_dict(state_dict)
+        if mode == "ddp":
+            run_model(DistributedDataParallel(model), batch, backward=True)
+        else:
+            run_tbptt(model, batch, TIMESTEPS // 3)
+            distributed.all_reduce_gradients(model)
+        grads[mode] = gradients(model)
+    if distributed.is_main_process():
+        torch.save(grads, result_path)
+    distributed.cleanup()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_distributed_gradients(tmp_path):
+    graphs = synthetic_graphs(structure_num=2 * WORLD_SIZE)
+    model = build_model("cell")
+    grads = {}
+    for mode in ["ddp", "tbptt"]:
+        model.zero_grad()
+        if mode == "ddp":
+            run_model(model, collate(graphs), backward=True)
+        else:
+            run_tbptt(model, collate(graphs), TIMESTEPS // 3)
+        grads[mode] = gradients(model)
+
+    result_path = str(tmp_path / "grads.pt")
+    mp.spawn(distributed_worker, args=(graphs, model.state_dict(), free_port(), result_path), nprocs=WORLD_SIZE)
+    distributed_grads = torch.load(result_path)
+    for mode in ["ddp", "tbptt"]:
+        assert_gradients_close(grads[mode], distributed_grads[mode], ATOL)
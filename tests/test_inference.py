@@ -0,0 +1,77 @@
+import torch
+from torch_geometric.data import Data
+import pytest
+
+
+from synthetic import TIMESTEPS, synthetic_graphs, collate, build_model
+from Models import inference
+from Utils import utils
+
+
+ATOL = 1e-5
+
+
+
+# The exported TorchScript module must give the outputs of the eager model (no_grad, every node).
+def test_scripted_matches_eager(tmp_path):
+    model = build_model("cell").eval()
+    path = str(tmp_path / "model_Best_inference.pt")
+    inference.export_inference_model(model, path)
+    scripted_model = inference.load_inference_model(path)
+
+    batch = collate(synthetic_graphs(structure_num=2, sample_ratio=1.0))
+    inputs = (batch.x, batch.edge_index, batch.edge_attr, batch.batch)
+    with torch.no_grad():
+        eager_output, _ = model(*inputs, batch.ptr, batch.sampled_node_index, batch.ground_motions, sample_node=False)
+        scripted_output = scripted_model(*inputs, batch.ground_motions)
+    assert scripted_output.shape == eager_output.shape
+    assert torch.allclose(eager_output, scripted_output, atol=ATOL)
+
+
+
+# One structure under several ground motions: the collated batch of the structure once per ground motion
+# (what the DataLoader would build) is the reference of the ground motion sweep paths.
+def sweep_reference(model, graph, ground_motions):
+    graphs = [Data(x=graph.x, edge_index=graph.edge_index, edge_attr=graph.edge_attr, ground_motions=ground_motions[i : i + 1],
+                   sampled_node_index=graph.sampled_node_index) for i in range(ground_motions.shape[0])]
+    batch = collate(graphs)
+    output, _ = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions,
+                      sample_node=False)
+    return output.view(ground_motions.shape[0], graph.num_nodes, ground_motions.shape[1], -1)
+
+
+def test_cached_encoding_matches_collated():
+    model = build_model("cell").eval()
+    graph = synthetic_graphs(structure_num=1, sample_ratio=1.0)[0]
+    ground_motions = torch.randn(4, TIMESTEPS, 20) * 0.1
+    cache = inference.StructureEncodingCache(model)
+    with torch.no_grad():
+        reference = sweep_reference(model, graph, ground_motions)
+        for _ in range(2):
+            output = inference.predict_ground_motions(model, graph.x, graph.edge_index, graph.edge_attr, ground_motions, cache)
+            assert torch.allclose(reference, output, atol=ATOL)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_ground_motion_batch_matches_collated():
+    model = build_model("cell").eval()
+    graph = synthetic_graphs(structure_num=1, sample_ratio=1.0)[0]
+    ground_motions = torch.randn(4, TIMESTEPS, 20) * 0.1
+    with torch.no_grad():
+        reference = sweep_reference(model, graph, ground_motions)
+        output = model.forward_ground_motions(graph.x, graph.edge_index, graph.edge_attr, ground_motions)
+    assert output.shape == reference.shape
+    assert torch.allclose(reference, output, atol=ATOL)
+
+
+def test_selective_output_matches_full_output():
+    model = build_model("cell").eval()
+    graph = synthetic_graphs(structure_num=1, sample_ratio=1.0)[0]
+    ground_motions = torch.randn(3, TIMESTEPS, 20) * 0.1
+    node_index = torch.tensor([0, 5, 11])
+    output_index = utils.get_output_index(["disp"])
+    with torch.no_grad():
+        reference = model.forward_ground_motions(graph.x, graph.edge_index, graph.edge_attr, ground_motions)
+        output = model.forward_ground_motions(graph.x, graph.edge_index, graph.edge_attr, ground_motions, node_index, output_index)
+    assert output.shape == (3, 3, TIMESTEPS, output_index.shape[0])
+    assert torch.allclose(reference[:, node_index][..., output_index], output, atol=ATOL)
@@ -0,0 +1,88 @@
+import torch
+from torch.profiler import profile, ProfilerActivity
+import pytest
+
+
+from Utils import accuracy
+from synthetic import TIMESTEPS, synthetic_graphs, collate, build_model, run_model, gradients, assert_gradients_close
+
+
+ATOL = 1e-5
+
+
+
+# The fused decoder must give the outputs and gradients of the cell decoder (same weights).
+@pytest.mark.parametrize("grad_enabled", [True, False])
+def test_fused_matches_cell(grad_enabled):
+    batch = collate(synthetic_graphs())
+    cell_model = build_model("cell")
+    fused_model = build_model("fused")
+    fused_model.load_state_dict(cell_model.state_dict())
+
+    with torch.set_grad_enabled(grad_enabled):
+        cell_output = run_model(cell_model, batch, backward=grad_enabled)
+        fused_output = run_model(fused_model, batch, backward=grad_enabled)
+    assert torch.allclose(cell_output, fused_output, atol=ATOL)
+    if grad_enabled:
+        assert_gradients_close(gradients(cell_model), gradients(fused_model), ATOL)
+
+
+
+# In torch.no_grad() the cell decoder runs in place on preallocated workspaces (DecoderWorkspace):
+# it must give the outputs of the autograd path, and the allocations of a forward must not grow with the timesteps.
+def count_allocations(fn):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return len([event for event in prof.events() if event.cpu_memory_usage > 0])
+
+
+def test_no_grad_cell_decoder_matches_autograd():
+    batch = collate(synthetic_graphs())
+    model = build_model("cell")
+    output = run_model(model, batch)
+    with torch.no_grad():
+        inplace_output = run_model(model, batch)
+    assert torch.allclose(output, inplace_output, atol=ATOL)
+
+
+def test_no_grad_cell_decoder_allocations():
+    batch = collate(synthetic_graphs(timesteps=2 * TIMESTEPS))
+    model = build_model("cell").eval()
+    allocations = []
+    for timesteps in [TIMESTEPS, 2 * TIMESTEPS]:
+        ground_motions = batch.ground_motions[:, :timesteps].contiguous()
+        with torch.no_grad():
+            allocations.append(count_allocations(lambda: model(batch.x, batch.edge_index, batch.edge_attr, batch.batch,
+                                                               batch.ptr, batch.sampled_node_index, ground_motions)))
+    assert allocations[0] == allocations[1]
+
+
+
+# Checkpointed blocks recompute the same activations in backward, so the gradients must not change.
+@pytest.mark.parametrize("node_decoder", ["cell", "fused"])
+def test_checkpoint_gradients(node_decoder):
+    batch = collate(synthetic_graphs())
+    model = build_model(node_decoder)
+    grads = []
+    for block in [0, TIMESTEPS // 3]:
+        model.nodeTimeSeriesDecoder.checkpoint_timesteps = block
+        model.zero_grad()
+        run_model(model, batch, backward=True)
+        grads.append(gradients(model))
+    assert_gradients_close(grads[0], grads[1], ATOL)
+
+
+
+# bfloat16 autocast must keep the accuracy of the float32 model: R2_score and peak_R2_score of the
+# bfloat16 outputs against the float32 outputs (train forward and no_grad inference of both decoders).
+@pytest.mark.parametrize("node_decoder", ["cell", "fused"])
+@pytest.mark.parametrize("grad_enabled", [True, False])
+def test_bf16_accuracy(node_decoder, grad_enabled, min_R2=0.99):
+    batch = collate(synthetic_graphs())
+    model = build_model(node_decoder)
+    with torch.set_grad_enabled(grad_enabled):
+        output = run_model(model, batch).detach()
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            bf16_output = run_model(model, batch).detach().float()
+    assert accuracy.R2_score(bf16_output, output).item() > min_R2
+    assert accuracy.peak_R2_score(bf16_output, output).item() > min_R2
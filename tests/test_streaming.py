@@ -0,0 +1,35 @@
+import torch
+import pytest
+
+
+from synthetic import NODE_NUM, TIMESTEPS, synthetic_graphs, build_model
+from Utils import streaming
+from Utils.ground_motion import fold_ground_motion
+
+
+ATOL = 1e-5
+
+
+
+# Samples pushed in uneven chunks (the incomplete frames wait for the next push) must give the responses
+# of the whole sequence at once; the identity normalization makes the streamed raw samples the folded ground motions.
+@pytest.mark.parametrize("chunk_max", [3, 40])
+def test_streaming_matches_whole_sequence(chunk_max):
+    model = build_model("cell").eval()
+    graph = synthetic_graphs(structure_num=1, sample_ratio=1.0)[0]
+    structure = (graph.x, graph.edge_index, graph.edge_attr)
+    norm_dict = {key: [0.0, 1.0] for key in ["acc", "vel", "disp", "momentY", "momentZ", "shearY", "shearZ", "ground_motion"]}
+    records = torch.randn(TIMESTEPS * 10, 2) * 0.1
+    ground_motions = torch.cat([torch.from_numpy(fold_ground_motion(records[:, i].numpy(), TIMESTEPS)) for i in range(2)], dim=1)
+
+    with torch.no_grad():
+        reference, _ = model(*structure, torch.zeros(NODE_NUM, dtype=torch.long), None, None, ground_motions.unsqueeze(0), sample_node=False)
+        stream = streaming.StreamingPredictor(model, *structure, norm_dict)
+        outputs, start = [], 0
+        while start < records.shape[0]:
+            end = start + torch.randint(1, chunk_max, (1,)).item()
+            outputs.append(stream.push(records[start:end]))
+            start = end
+
+    assert stream.frame_num == TIMESTEPS
+    assert torch.allclose(reference, torch.cat(outputs, dim=1), atol=ATOL)
@@ -1,5 +1,7 @@
 import torch
-from torch.utils.data import random_split
+from torch.utils.data import random_split, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch_geometric.loader import DataLoader
 import torch.optim as optim
 import numpy as np
@@ -7,7 +9,6 @@ import time
 import random
 from datetime import datetime
 import os
-import gc
 import json
 import logging
 from tqdm import tqdm
@@ -21,10 +22,14 @@ sys.path.append("../")
 
 from Models.LSTM import *
 from Models.losses import *
+from Models import inference
 from Utils import plot
 from Utils import visualize
 from Utils import accuracy
 from Utils import dataset
+from Utils import distributed
+from Utils import sampler
+from Utils import prefetch
 from Utils import normalization
 from Utils import utils
 
@@ -48,6 +53,12 @@ def parse_args() -> Namespace:
     parser.add_argument("--random_sample", type=bool, default=True)
     parser.add_argument("--timesteps", type=int, default=1400)
     parser.add_argument("--train_split_ratio", type=list, default=[0.7, 0.2, 0.1])
+    parser.add_argument("--dataset_cache", type=Path, default=None, help="compiled dataset cache folder, compiled on the first run")
+    parser.add_argument("--ground_motion_root", type=str, default=dataset.GROUND_MOTION_ROOT, help="folder of the ground motion records referenced by ground_motion.json, it must hold the level folders of the ground motion source of generate_random_structure (e.g. GroundMotions_World_processed_BSE-1)")
+    parser.add_argument("--load_workers", type=int, default=0, help="worker processes for loading the structure folders, 0 loads them in the main process")
+    parser.add_argument("--mmap", action="store_true", default=False, help="keep y and ground motions memory-mapped from the dataset cache, normalize them per batch")
+    parser.add_argument("--cache_dtype", type=str, default='float32', choices=list(dataset.STORAGE_DTYPES.keys()), help="storage dtype of y and ground motions in the dataset cache")
+    parser.add_argument("--norm_percentiles", type=float, nargs="*", default=[], help="also estimate these per channel percentiles of the features (saved with the dataset cache statistics)")
 
     # model
     parser.add_argument("--pretrain_path", type=Path, default=None)
@@ -60,6 +71,7 @@ def parse_args() -> Namespace:
     parser.add_argument("--graph_lstm_num_layers", type=int, default=1)
     parser.add_argument("--node_lstm_hidden_dim", type=int, default=256)
     parser.add_argument("--node_lstm_num_layers", type=int, default=2)
+    parser.add_argument("--node_decoder", type=str, default='cell', choices=['cell', 'fused'], help="cell: LSTMCell loop over timesteps, fused: full-sequence LSTM per layer (same weights)")
 
     # training
     parser.add_argument("--loss_function", type=str, default='MSE')
@@ -69,22 +81,34 @@ def parse_args() -> Namespace:
     parser.add_argument("--target", type=str, default='acc_vel_disp_My_Mz_Sy_Sz')
     parser.add_argument("--epoch_num", type=int, default=300)
     parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--prefetch", type=int, default=2, help="batches collated (and moved to the device) ahead in a background thread, 0: synchronously")
+    parser.add_argument("--batch_nodes", type=int, default=0, help="pack batches to this node budget instead of batch_size graphs (0: batch_size graphs)")
+    parser.add_argument("--batch_node_count", type=str, default='node', choices=['node', 'sampled'], help="nodes counted in --batch_nodes, all nodes or only the sampled ones")
+    parser.add_argument("--checkpoint_timesteps", type=int, default=0, help="activation checkpointing of the node decoder: keep only the states every checkpoint_timesteps timesteps, recompute the rest in backward (0: off)")
+    parser.add_argument("--bf16", action="store_true", default=False, help="bfloat16 autocast of the model (GNN, graph LSTM, node decoder), loss and accuracy stay float32")
+    parser.add_argument("--tbptt_window", type=int, default=0, help="truncated backpropagation through time: backward every tbptt_window timesteps and detach the LSTM states (0: whole sequence)")
     parser.add_argument("--random_seed", type=int, default=731, help="fixed random seed")
+    parser.add_argument("--dist_backend", type=str, default='gloo', help="torch.distributed backend when started with torchrun (batch_size is per process)")
     parser.add_argument("--neglect_beam_My_Sz", action="store_true", default=True, help="neglect beams' My, Sz in the loss, accuracy calculation")
 
     # others
     parser.add_argument("--yield_factor", type=float, default=0.90)
     parser.add_argument("--plot_num", type=int, default=5)
     parser.add_argument("--training_time", type=float, default=0)
+    parser.add_argument("--export_inference", action="store_true", default=False, help="also save the best model as a TorchScript inference module (model_Best_inference.pt)")
 
     args = parser.parse_args()
     return args
 
 
 
-def get_loggings(ckpt_dir):
+def get_loggings(ckpt_dir, main_process=True):
 	logger = logging.getLogger(name='GraphLSTM')
 	logger.setLevel(level=logging.INFO)
+	# only rank 0 logs in distributed training
+	if not main_process:
+		logger.disabled = True
+		return logger
 	# set formatter
 	formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 	# console handler
@@ -107,69 +131,162 @@ def set_random_seed(SEED: int):
 
 
 
+# Truncated backpropagation through time: the sequence is decoded in windows of window timesteps,
+# the LSTM states are carried to the next window but detached, so backward only keeps one window of
+# activations. The graph latent is encoded once per batch and its gradient is accumulated over the windows.
+# (loss of each window is weighted by its length, so the gradient of window >= timesteps equals the full sequence)
+def train_step_tbptt(model, batch, criterion, channel_index, window):
+    latent, node, keeped_indexes, node_graph_index = model.encode(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.sampled_node_index)
+    latent_leaf = latent.detach().requires_grad_()
+    y = batch.y.index_select(0, keeped_indexes)
+    timesteps = batch.ground_motions.shape[1]
+
+    state, outputs, loss_sum = None, [], 0
+    for start in range(0, timesteps, window):
+        end = min(start + window, timesteps)
+        output, state = model.forward_window(latent_leaf, node, node_graph_index, batch.ground_motions[:, start:end], state)
+        y_window = y[:, start:end]
+
+        mask_y = y_window.index_select(-1, channel_index)
+        mask_output = output.index_select(-1, channel_index)
+
+        loss = criterion(mask_output, mask_y) * ((end - start) / timesteps)
+        loss.backward()
+        loss_sum += loss.item()
+        outputs.append(output.detach())
+        state = state.detach()
+
+    latent.backward(latent_leaf.grad)
+    return torch.cat(outputs, dim=1), keeped_indexes, torch.tensor(loss_sum)
+
+
+
 def main(args):
+    # distributed training (started with torchrun), every rank uses the checkpoint folder of rank 0
+    # but only rank 0 writes into it
+    rank, world_size = distributed.init_distributed(args.dist_backend)
+    main_process = distributed.is_main_process()
+
     # args, logger setting
-    date_str = datetime.now().strftime("%Y_%m_%d__%H_%M_%S")
+    date_str = distributed.broadcast_object(datetime.now().strftime("%Y_%m_%d__%H_%M_%S"))
     args.ckpt_dir = args.ckpt_dir / args.dataset_name / date_str
-    args.ckpt_dir.mkdir(parents=True, exist_ok=True)
-    logger = get_loggings(args.ckpt_dir)
+    model_dir =  args.ckpt_dir / "Models"
+    if main_process:
+        args.ckpt_dir.mkdir(parents=True, exist_ok=True)
+        model_dir.mkdir(parents=True, exist_ok=True)
+    logger = get_loggings(args.ckpt_dir, main_process)
     logger.info(f"ckpt_dir: {args.ckpt_dir}")
     logger.info(args)
 
-    model_dir =  args.ckpt_dir / "Models"
-    model_dir.mkdir(parents=True, exist_ok=True)
-
     # set random seed
+    # (the same on every rank, so they all get the same split and sampled nodes)
     set_random_seed(args.random_seed)
 
     # device
-    device = "cuda:0" if torch.cuda.is_available() else "cpu"
-    GPU_name = torch.cuda.get_device_name()
-    logger.info(f"My GPU is {GPU_name}\n")
+    if torch.cuda.is_available():
+        device = f"cuda:{distributed.get_local_rank() % torch.cuda.device_count()}"
+        GPU_name = torch.cuda.get_device_name(device)
+        logger.info(f"My GPU is {GPU_name}\n")
+    else:
+        device = "cpu"
+        logger.info(f"CPU training, {torch.get_num_threads()} threads per process\n")
+    if world_size > 1:
+        logger.info(f"Distributed training: {world_size} processes, {args.dist_backend} backend\n")
 
     # dataset
-    dset = dataset.GroundMotionDataset(folder=args.dataset_name,
-                                       graph_type=args.whatAsNode,
-                                       data_num=args.data_num,
-                                       timesteps=args.timesteps,
-                                       other_folders=args.other_datasets)
+    # (distributed: rank 0 compiles the dataset cache and its statistics first, the other ranks load them)
+    if not main_process:
+        distributed.barrier()
+    if args.mmap and args.dataset_cache is None:
+        raise ValueError("--mmap needs a compiled dataset, please set --dataset_cache")
+    if args.dataset_cache is None:
+        dset = dataset.GroundMotionDataset(folder=args.dataset_name,
+                                           graph_type=args.whatAsNode,
+                                           data_num=args.data_num,
+                                           timesteps=args.timesteps,
+                                           other_folders=args.other_datasets,
+                                           num_workers=args.load_workers,
+                                           ground_motion_root=args.ground_motion_root)
+    else:
+        # (a cache compiled with other dataset arguments is refused instead of silently reused)
+        cache_parameters = dataset.cache_parameters(args.dataset_name, args.whatAsNode, args.data_num, args.timesteps,
+                                                    args.other_datasets, args.cache_dtype)
+        if not (args.dataset_cache / dataset.CACHE_INDEX).exists():
+            logger.info(f"Compiling dataset cache: {args.dataset_cache}")
+            dataset.compile_dataset(args.dataset_cache,
+                                    folder=args.dataset_name,
+                                    graph_type=args.whatAsNode,
+                                    data_num=args.data_num,
+                                    timesteps=args.timesteps,
+                                    other_folders=args.other_datasets,
+                                    num_workers=args.load_workers,
+                                    ground_motion_root=args.ground_motion_root,
+                                    storage_dtype=args.cache_dtype)
+        dset = dataset.CompiledGroundMotionDataset(args.dataset_cache, mmap=args.mmap, parameters=cache_parameters)
+        logger.info(f"Loaded dataset cache: {args.dataset_cache} ({dset.storage_dtype} y, ground motions)")
     logger.info(f"Num of structure graph: {len(dset)}")
     logger.info(f"structure_1 graph data: {dset[0]}\n")
 
     # normalization
-    dataset_norm, norm_dict = normalization.normalize_dataset(dset, random_sample=args.random_sample)
+    # (normalized in place, dset's graphs become the normalized ones instead of being copied)
+    # (with a dataset cache, random is seeded again: only the rank that compiles it runs select_folders,
+    #  which reseeds random, and the sampled nodes must be the same on every rank)
+    if args.dataset_cache is not None:
+        random.seed(args.random_seed)
+    dataset_norm, norm_dict = normalization.normalize_dataset(dset, random_sample=args.random_sample, lazy=args.mmap, inplace=True,
+                                                                percentiles=args.norm_percentiles)
+    if main_process:
+        distributed.barrier()
     logger.info(f"Normlization structure_1 graph: {dataset_norm[0]}")
     logger.info(f"Normalized feastures: \n{norm_dict}\n")
 
-    # remove the memory usage of original dataset
-    del dset
-    gc.collect()
-    logger.info("Remove the memory usage of original dataset!\n")
-
     # spilt into train_dataset, valid dataset and test dataset
     data_num = len(dataset_norm)
     train_ratio, valid_ratio, test_ratio = args.train_split_ratio
     train_num, valid_num = int(data_num*train_ratio), int(data_num*valid_ratio)
     test_num = data_num - train_num - valid_num
     train_index, valid_index, test_index = random_split(list(range(data_num)), [train_num, valid_num, test_num])
-    train_dataset = [dataset_norm[i] for i in list(train_index)]
-    valid_dataset = [dataset_norm[i] for i in list(valid_index)]
-    test_dataset = [dataset_norm[i] for i in list(test_index)]
+    train_dataset = Subset(dataset_norm, list(train_index))
+    valid_dataset = Subset(dataset_norm, list(valid_index))
+    test_dataset = Subset(dataset_norm, list(test_index))
     logger.info(f"train data: {len(train_dataset)}")
     logger.info(f"valid data: {len(valid_dataset)}")
     logger.info(f"test data: {len(test_dataset)}\n")
 
     # dataloader
+    # (distributed: each rank gets its share of the structures, batch_size per process)
     batch_size = args.batch_size
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_sampler, valid_sampler, test_sampler = None, None, None
+    if args.batch_nodes > 0:
+        # batches of graphs with similar sizes, packed to a node budget
+        train_sampler, valid_sampler, test_sampler = [
+            sampler.NodeBudgetBatchSampler(sampler.graph_sizes(d, args.batch_node_count), args.batch_nodes, shuffle=shuffle,
+                                           seed=args.random_seed, num_replicas=world_size, rank=rank)
+            for d, shuffle in zip([train_dataset, valid_dataset, test_dataset], [True, False, False])]
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler)
+        valid_loader = DataLoader(valid_dataset, batch_sampler=valid_sampler)
+        test_loader = DataLoader(test_dataset, batch_sampler=test_sampler)
+    else:
+        if world_size > 1:
+            train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=args.random_seed)
+            valid_sampler = DistributedSampler(valid_dataset, shuffle=False)
+            test_sampler = DistributedSampler(test_dataset, shuffle=False)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=(train_sampler is None), sampler=train_sampler)
+        valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, sampler=valid_sampler)
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, sampler=test_sampler)
     miniBatch = next(iter(train_loader))
-    logger.info(f"Batch size = {batch_size}")
+    if args.batch_nodes > 0:
+        logger.info(f"Batch node budget = {args.batch_nodes} ({args.batch_node_count} nodes), {len(train_loader)} train batches")
+    else:
+        logger.info(f"Batch size = {batch_size}")
     logger.info(f"One mini DataBatch for training:\n{miniBatch}")
-    logger.info(f"graph sampled_index: {miniBatch.sampled_index}")
+    logger.info(f"graph sampled_node_index: {miniBatch.sampled_node_index}")
     logger.info(f"graph ptr: {miniBatch.ptr}")
 
+    # the next batches are collated (pinned and copied to the GPU) in the background while one trains
+    train_loader, valid_loader, test_loader = [prefetch.PrefetchLoader(loader, device, args.prefetch)
+                                               for loader in [train_loader, valid_loader, test_loader]]
+
     # start index, end index, inedx of target feature dict
     y_start, y_finish, target_dict = utils.get_target_index(args.target, args.neglect_beam_My_Sz)
     logger.info(f"Get predict target's index: start at {y_start}, end at {y_finish}")
@@ -181,26 +298,32 @@ def main(args):
     ground_motion_dim = dataset_norm[0].ground_motions.shape[-1]
     output_dim = y_finish - y_start
 
-    # save trainig arguments, norm_dict
-    args_temp = deepcopy(args)
-    args_temp.ckpt_dir = str(args_temp.ckpt_dir)
-    with open(args.ckpt_dir / 'training_args.json', 'w') as f:
-        json.dump(vars(args_temp), f)
-
-    norm_dict_save = {}
-    for key in norm_dict.keys():
-        norm_dict_save[key] = norm_dict[key]
-
-    with open(args.ckpt_dir / 'norm_dict.json', 'w') as f:
-        json.dump(norm_dict_save, f)
-        
-    # save all dataset data path
-    data_paths = {}
-    data_paths['train'] = [graph.path for graph in train_dataset]
-    data_paths['valid'] = [graph.path for graph in valid_dataset]
-    data_paths['test'] = [graph.path for graph in test_dataset]
-    with open(args.ckpt_dir / 'data_paths.json', 'w') as f:
-        json.dump(data_paths, f)
+    # channels of y, output in the loss and overall accuracy (the same for every batch)
+    channel_index = utils.get_channel_index(output_dim, args.neglect_beam_My_Sz, device)
+
+    # save trainig arguments, norm_dict (rank 0)
+    if main_process:
+        args_temp = deepcopy(args)
+        args_temp.ckpt_dir = str(args_temp.ckpt_dir)
+        with open(args.ckpt_dir / 'training_args.json', 'w') as f:
+            json.dump(vars(args_temp), f, default=str)  # (Path arguments)
+
+        norm_dict_save = {}
+        for key in norm_dict.keys():
+            norm_dict_save[key] = norm_dict[key]
+
+        with open(args.ckpt_dir / 'norm_dict.json', 'w') as f:
+            json.dump(norm_dict_save, f)
+
+        # save all dataset data path
+        # (a lazily normalized dataset keeps the paths, so the graphs don't have to be loaded for them)
+        paths = dataset_norm.paths if args.mmap else [graph.path for graph in dataset_norm]
+        data_paths = {}
+        data_paths['train'] = [paths[i] for i in train_dataset.indices]
+        data_paths['valid'] = [paths[i] for i in valid_dataset.indices]
+        data_paths['test'] = [paths[i] for i in test_dataset.indices]
+        with open(args.ckpt_dir / 'data_paths.json', 'w') as f:
+            json.dump(data_paths, f)
 
     # construct model
     model_constructor_args = {
@@ -208,15 +331,22 @@ def main(args):
         'head_num': args.head_num, 'latent_dim': args.latent_dim, 'graph_lstm_hidden_dim': args.graph_lstm_hidden_dim,
         'graph_lstm_num_layers': args.graph_lstm_num_layers,'node_lstm_hidden_dim': args.node_lstm_hidden_dim, 
         'node_lstm_num_layers': args.node_lstm_num_layers, 'ground_motion_dim': ground_motion_dim,
-        'output_dim': output_dim, 'device': device}
+        'output_dim': output_dim, 'device': device, 'node_decoder': args.node_decoder,
+        'checkpoint_timesteps': args.checkpoint_timesteps}
     model = globals()[args.model](**model_constructor_args).to(device)
     logger.info(model)
 
-    if args.pretrain != None:
+    if args.pretrain_path != None:
         pretrain_path = Path("../Results/") / args.pretrain_path
-        model.load_state_dict(torch.load(pretrain_path))
+        model.load_state_dict(torch.load(pretrain_path, map_location=device))
         logger.info(f"Loaded pretrain model: {pretrain_path}")
 
+    # distributed: the gradients of a ddp_model backward are averaged over the ranks,
+    # everything else (truncated BPTT windows, evaluation, checkpoints) uses model itself
+    ddp_model = model
+    if world_size > 1:
+        ddp_model = DistributedDataParallel(model, device_ids=[device] if device.startswith("cuda") else None)
+
     # loss function
     criterion = globals()[args.loss_function]()
 
@@ -238,32 +368,39 @@ def main(args):
     best_loss = np.inf
     ps_record_Mz = np.zeros((3, args.epoch_num, 4))   # [3 for train/valid/test, epoch_num, 4 for TP/FP/FN/TN]
     ps_record_Mz_1F = np.zeros((3, args.epoch_num, 4))   # [3 for train/valid/test, epoch_num, 4 for TP/FP/FN/TN]
+    stall_record = np.zeros((3, args.epoch_num))   # seconds spent waiting for batches
 
     # train
     start_time = time.time()
     for epoch in range(epochs):
         model.train()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         R2_acc_train = 0
         peak_acc_train = 0
         loss_train, elem_train = 0, 0
         for batch in tqdm(train_loader):
             batch = batch.to(device)
-            output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_index, batch.ground_motions)
-            x, y = batch.x[keeped_indexes], batch.y[keeped_indexes]
-
-            mask = torch.ones(y.shape, dtype=bool)
-            if args.neglect_beam_My_Sz:
-                mask[:, :, (6,7,10,11)] = False    # neglect beam's MomentY
-                mask[:, :, (24,25,28,29)] = False  # neglect beam's ShearZ
-            mask_y = y[mask].reshape(y.shape[0], y.shape[1], -1)
-            mask_output = output[mask].reshape(output.shape[0], output.shape[1], -1)
-
-            # calculate loss
-            loss = criterion(mask_output, mask_y)
-
-            # calculate gradient and back propagation
             optimizer.zero_grad()  # clean the gradient
-            loss.backward()
+            with torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=args.bf16):
+                if args.tbptt_window > 0:
+                    # loss and gradient are calculated window by window
+                    output, keeped_indexes, loss = train_step_tbptt(model, batch, criterion, channel_index, args.tbptt_window)
+                    distributed.all_reduce_gradients(model)
+                else:
+                    output, keeped_indexes = ddp_model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions)
+            output = output.float()
+            x, y = batch.x.index_select(0, keeped_indexes), batch.y.index_select(0, keeped_indexes)
+
+            mask_y = y.index_select(-1, channel_index)
+            mask_output = output.index_select(-1, channel_index)
+
+            if args.tbptt_window <= 0:
+                # calculate loss
+                loss = criterion(mask_output, mask_y)
+
+                # calculate gradient and back propagation
+                loss.backward()
             optimizer.step()
 
             # calculate accuracy
@@ -278,6 +415,15 @@ def main(args):
             peak_acc_train += peak_acc
             elem_train += 1
 
+        stall_record[0][epoch] = train_loader.stall_time
+
+        # sum the metrics of every rank (distributed training)
+        R2_acc_train, peak_acc_train, loss_train, elem_train = distributed.all_reduce_sum([R2_acc_train, peak_acc_train, loss_train, elem_train])
+        target_R2_record = distributed.all_reduce_target_accuracy(target_R2_record, epoch, t_v=0)
+        target_peak_record = distributed.all_reduce_target_accuracy(target_peak_record, epoch, t_v=0)
+        distributed.all_reduce_plastic_hinge(plasticHingeClassifier)
+        distributed.all_reduce_plastic_hinge(plasticHingeClassifier_1F)
+
         # record accuracy and loss for each epoch
         R2_acc_record[0][epoch] = R2_acc_train / elem_train  
         peak_acc_record[0][epoch] = peak_acc_train / elem_train  
@@ -297,15 +443,13 @@ def main(args):
                 loss_valid, elem_valid = 0, 0
                 for batch in loader:
                     batch = batch.to(device)
-                    output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_index, batch.ground_motions)
-                    x, y = batch.x[keeped_indexes], batch.y[keeped_indexes]
+                    with torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=args.bf16):
+                        output, keeped_indexes = model(batch.x, batch.edge_index, batch.edge_attr, batch.batch, batch.ptr, batch.sampled_node_index, batch.ground_motions)
+                    output = output.float()
+                    x, y = batch.x.index_select(0, keeped_indexes), batch.y.index_select(0, keeped_indexes)
                     
-                    mask = torch.ones(y.shape, dtype=bool)
-                    if args.neglect_beam_My_Sz:
-                        mask[:, :, (6,7,10,11)] = False    # neglect beam's MomentY
-                        mask[:, :, (24,25,28,29)] = False  # neglect beam's ShearZ
-                    mask_y = y[mask].reshape(y.shape[0], y.shape[1], -1)
-                    mask_output = output[mask].reshape(output.shape[0], output.shape[1], -1)
+                    mask_y = y.index_select(-1, channel_index)
+                    mask_output = output.index_select(-1, channel_index)
 
                     # calculate loss
                     loss = criterion(mask_output, mask_y)
@@ -322,6 +466,15 @@ def main(args):
                     peak_acc_valid += peak_acc
                     elem_valid += 1
 
+                stall_record[t_v][epoch] = loader.stall_time
+
+                # sum the metrics of every rank (distributed training)
+                R2_acc_valid, peak_acc_valid, loss_valid, elem_valid = distributed.all_reduce_sum([R2_acc_valid, peak_acc_valid, loss_valid, elem_valid])
+                target_R2_record = distributed.all_reduce_target_accuracy(target_R2_record, epoch, t_v=t_v)
+                target_peak_record = distributed.all_reduce_target_accuracy(target_peak_record, epoch, t_v=t_v)
+                distributed.all_reduce_plastic_hinge(plasticHingeClassifier)
+                distributed.all_reduce_plastic_hinge(plasticHingeClassifier_1F)
+
                 # record accuracy and loss for each epoch
                 R2_acc_record[t_v][epoch] = R2_acc_valid / elem_valid
                 peak_acc_record[t_v][epoch] = peak_acc_valid / elem_valid
@@ -344,17 +497,20 @@ def main(args):
         text += f'T_Peak_Acc: {peak_acc_record[0][epoch]:.4f}, V_Peak_Acc: {peak_acc_record[1][epoch]:.4f}, t_Peak_Acc: {peak_acc_record[2][epoch]:.4f}, '
         text += f'T_Loss: {loss_record[0][epoch]:.6f}, V_Loss: {loss_record[1][epoch]:.6f}, t_Loss: {loss_record[2][epoch]:.6f}, '    
         text += f'T_hinge_node_Mz: {train_ps_result_Mz}, V_hinge_node_Mz: {valid_ps_result_Mz}, t_hinge_node_Mz: {test_ps_result_Mz},  '
-        text += f'T_hinge_node_Mz_1F: {train_ps_result_Mz_1F}, V_hinge_node_Mz_1F: {valid_ps_result_Mz_1F}, t_hinge_node_Mz_1F: {test_ps_result_Mz_1F}'
+        text += f'T_hinge_node_Mz_1F: {train_ps_result_Mz_1F}, V_hinge_node_Mz_1F: {valid_ps_result_Mz_1F}, t_hinge_node_Mz_1F: {test_ps_result_Mz_1F}, '
+        text += f'T_Stall: {stall_record[0][epoch]:.2f}s, V_Stall: {stall_record[1][epoch]:.2f}s, t_Stall: {stall_record[2][epoch]:.2f}s'
 
         logger.critical(text)
 
-        if (epoch + 1) % 50 == 0:
+        if (epoch + 1) % 50 == 0 and main_process:
             torch.save(model.state_dict(), model_dir / f'model_Epoch{epoch+1}.pt')
         
         # Save model if train_loss is better
+        # (the valid loss is the same on every rank, only rank 0 saves)
         if loss_record[1][epoch] < best_loss:
             best_loss = loss_record[1][epoch]
-            torch.save(model.state_dict(), model_dir / 'model_Best.pt')
+            if main_process:
+                torch.save(model.state_dict(), model_dir / 'model_Best.pt')
             text = f'Trained model saved, valid loss: {best_loss:.6f}'
             logger.critical(text)
 
@@ -365,6 +521,11 @@ def main(args):
     logger.info(f"Time spent: {(finish_time - start_time)/60:.2f} min")
     logger.info("Finish time: " + datetime.now().strftime('%b %d, %H:%M:%S'))
 
+    # records, figures and the best model evaluation are done by rank 0 alone
+    distributed.cleanup()
+    if not main_process:
+        return
+
     # save record
     record_dir = args.ckpt_dir / "Records"
     record_dir.mkdir(parents=True, exist_ok=True)
@@ -384,6 +545,7 @@ def main(args):
 
     with open(record_dir / "ps_record_Mz.txt", 'w') as f: json.dump(ps_record_Mz.tolist(), f)
     with open(record_dir / "ps_record_Mz_1F.txt", 'w') as f: json.dump(ps_record_Mz_1F.tolist(), f)
+    with open(record_dir / "stall_record.txt", 'w') as f: json.dump(stall_record.tolist(), f)
 
 
     # plot figures
@@ -398,7 +560,12 @@ def main(args):
     
     # reload the best model
     model = globals()[args.model](**model_constructor_args).to(device)
-    model.load_state_dict(torch.load(args.ckpt_dir / 'model_Best.pt'))
+    model.load_state_dict(torch.load(model_dir / 'model_Best.pt'))
+
+    # standalone TorchScript inference module of the best model (CPU)
+    if args.export_inference:
+        inference.export_inference_model(model, model_dir / 'model_Best_inference.pt')
+        logger.info(f"Exported inference model: {model_dir / 'model_Best_inference.pt'}")
 
     worst_case_index, best_case_index = plot.plot_test_accuracy_distribution(test_dataset, model, args.neglect_beam_My_Sz, args.ckpt_dir)
     logger.info(f"worst case index: {worst_case_index}, best case index: {best_case_index}")